@@ -0,0 +1,225 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from src.log_analyzer import (
+    Log,
+    _get_prepared_data,
+    _read_log,
+    _report_rows,
+    _write_report,
+    config,
+)
+
+TEMPLATE = os.path.join(
+    os.path.dirname(__file__), "src", "reports", "report-template.html"
+)
+
+URL_PATTERNS = (
+    "/api/v2/banner/{id}",
+    "/api/v2/banner/{id}/statistic/?date_from={date}&date_to={date}",
+    "/api/v2/group/{id}/statistic/sites/?date_type=day&date_from={date}",
+    "/api/1/photogenic_banners/list/?server_name=WIN7RB{id}",
+    "/api/v2/slot/{id}/groups",
+    "/export/appinstall_raw/{date}/",
+    "/accounts/login/?next=/campaigns/{id}/",
+    "/api/v2/internal/html5/phantomjs/queue/?wait=1m",
+)
+USER_AGENTS = (
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko)",
+    "python-requests/2.13.0",
+    "-",
+)
+STATUSES = (200,) * 17 + (301, 404, 499)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def generate_log(
+    path: str, lines: int, urls: int, broken_rate: float = 0.001, seed: int = 0
+) -> None:
+    """Write a synthetic ui_short log with `urls` distinct urls of zipf-like popularity."""
+    rng = random.Random(seed)
+    day = datetime(2017, 6, 30)
+    pool = [
+        rng.choice(URL_PATTERNS).format(
+            id=rng.randint(1, 10_000_000), date=(day - timedelta(days=i % 30)).date()
+        )
+        for i in range(urls)
+    ]
+    weights = [1 / rank for rank in range(1, urls + 1)]
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        for chunk_start in range(0, lines, 10_000):
+            size = min(10_000, lines - chunk_start)
+            rows = []
+            for url in rng.choices(pool, weights, k=size):
+                if rng.random() < broken_rate:
+                    rows.append(
+                        '0.0.0.0 -  - [30/Jun/2017:03:28:23 +0300] "0" 400 166\n'
+                    )
+                    continue
+                moment = day + timedelta(seconds=rng.randrange(86400))
+                rows.append(
+                    f"1.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)} "
+                    f"{rng.choice(('-', '3b81f63526fa8'))}  - "
+                    f"[{moment:%d/%b/%Y:%H:%M:%S} +0300] "
+                    f'"{rng.choice(("GET", "GET", "GET", "POST"))} {url} HTTP/1.1" '
+                    f'{rng.choice(STATUSES)} {rng.randrange(20, 20000)} "-" '
+                    f'"{rng.choice(USER_AGENTS)}" "-" '
+                    f'"1498697422-2190034393-4708-{rng.randrange(10**7)}" '
+                    f'"{rng.randrange(16**9):x}" '
+                    f"{rng.lognormvariate(-1.5, 1.2):.3f}\n"
+                )
+            f.write("".join(rows))
+
+
+def _print_stage(name: str, elapsed: float, lines: int = 0) -> None:
+    rate = f"{lines / elapsed:>12,.0f} lines/s" if lines else " " * 20
+    print(f"{name:<20} {elapsed:8.3f}s {rate}   peak RSS {_peak_rss_mb():8.1f} MB")
+
+
+def bench_stages(file_path: str, _config: dict) -> dict:
+    """Time every stage of create_report separately, return lines/s per stage."""
+    report_dir = tempfile.mkdtemp(prefix="log_analyzer_bench_")
+    shutil.copy(TEMPLATE, report_dir)
+    _config = {**_config, "REPORT_DIR": report_dir}
+    log = Log(
+        datetime(2017, 6, 30).date(),
+        os.path.basename(file_path),
+        file_path,
+        ".gz" if file_path.endswith(".gz") else "",
+    )
+    results = {}
+    try:
+        started = time.perf_counter()
+        lines = sum(1 for _ in _read_log(file_path, _config["GZIP_DECOMPRESSOR"]))
+        elapsed = time.perf_counter() - started
+        results["_read_log"] = lines / elapsed
+        _print_stage("_read_log", elapsed, lines)
+
+        started = time.perf_counter()
+        raw_data = _get_prepared_data(log, _config)
+        elapsed = time.perf_counter() - started
+        results["_get_prepared_data"] = lines / elapsed
+        _print_stage("_get_prepared_data", elapsed, lines)
+        urls = raw_data.urls_stat or raw_data.columns.url_ids_by_url
+        print(f"{'':<20} {len(urls)} distinct urls")
+
+        started = time.perf_counter()
+        report = _report_rows(raw_data, _config)
+        _print_stage("_report_rows", time.perf_counter() - started)
+
+        started = time.perf_counter()
+        _write_report(report, log, _config)
+        _print_stage("_write_report", time.perf_counter() - started)
+    finally:
+        shutil.rmtree(report_dir)
+    return results
+
+
+def bench_readers(file_path: str, repeat: int) -> None:
+    def measure(lines) -> tuple:
+        started = time.perf_counter()
+        count = sum(1 for _ in lines)
+        return count, time.perf_counter() - started
+
+    readers = {"legacy": lambda: _legacy_read_log(file_path)}
+    decompressors = ["python"]
+    if file_path.endswith(".gz"):
+        decompressors += [name for name in ("pigz", "zcat") if shutil.which(name)]
+    for name in decompressors:
+        readers[f"blocks/{name}"] = lambda name=name: _read_log(file_path, name)
+    for name, reader in readers.items():
+        count, elapsed = min(
+            (measure(reader()) for _ in range(repeat)), key=lambda x: x[1]
+        )
+        print(
+            f"{name:<14} {count:>10} lines {elapsed:8.3f}s {count / elapsed:>12,.0f} lines/s"
+        )
+
+
+def _legacy_read_log(file_path: str):
+    """The reader before byte-oriented blocks: readline() and decode() per line."""
+    with (
+        gzip.open(file_path, "r")
+        if file_path.endswith(".gz")
+        else open(file_path, "rb")
+    ) as f:
+        line = f.readline()
+        while line:
+            yield line.decode()
+            line = f.readline()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="log_analyzer benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="write a synthetic log")
+    generate.add_argument("path", help="output file, .gz to compress")
+    generate.add_argument("--lines", type=int, default=1_000_000)
+    generate.add_argument("--urls", type=int, default=10_000)
+    generate.add_argument("--seed", type=int, default=0)
+
+    stages = commands.add_parser("stages", help="time every report stage")
+    stages.add_argument("--log", help="existing log, a synthetic one by default")
+    stages.add_argument("--lines", type=int, default=1_000_000)
+    stages.add_argument("--urls", type=int, default=10_000)
+    stages.add_argument("--gzip", action="store_true")
+    stages.add_argument("--config", help="json with log_analyzer config overrides")
+    stages.add_argument(
+        "--min-lines-per-sec",
+        type=float,
+        default=0,
+        help="exit with an error if _get_prepared_data is slower",
+    )
+
+    readers = commands.add_parser("readers", help="compare line readers")
+    readers.add_argument("log", help="nginx log, plain or .gz")
+    readers.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate_log(args.path, args.lines, args.urls, seed=args.seed)
+    elif args.command == "readers":
+        bench_readers(args.log, args.repeat)
+    else:
+        _config = dict(config)
+        if args.config:
+            with open(args.config, "r") as f:
+                _config.update(json.load(f))
+        path = args.log
+        tmp_dir = None
+        if path is None:
+            tmp_dir = tempfile.mkdtemp(prefix="log_analyzer_bench_")
+            path = f"{tmp_dir}/nginx-access-ui.log-20170630{'.gz' if args.gzip else ''}"
+            started = time.perf_counter()
+            generate_log(path, args.lines, args.urls)
+            print(
+                f"generated {args.lines} lines in {time.perf_counter() - started:.1f}s"
+            )
+        try:
+            results = bench_stages(path, _config)
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir)
+        if results["_get_prepared_data"] < args.min_lines_per_sec:
+            print(f"_get_prepared_data is below {args.min_lines_per_sec:,.0f} lines/s")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
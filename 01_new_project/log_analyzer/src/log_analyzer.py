@@ -1,15 +1,31 @@
+import csv
 import gzip
+import heapq
 import json
 import logging
+import math
+import mmap
 import os
+import pickle
 import re
-import statistics
-import string
+import shutil
+import subprocess
 import sys
-from collections import namedtuple
+import zlib
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
 from copy import copy
-from datetime import datetime
-from typing import Union
+from datetime import date, datetime, timedelta
+from functools import partial
+from itertools import chain, islice
+from typing import Callable, Iterable, Iterator, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
@@ -22,97 +38,1038 @@ config = {
     "LOG_DIR": "./log",
     "SCRIPT_LOG_FILE": None,
     "ERROR_RATE": 51,
+    "WORKERS": 1,
+    "QUANTILE_MODE": "exact",
+    "QUANTILE_COMPRESSION": 100,
+    "INCREMENTAL": False,
+    "STATE_FILE": "./log_analyzer.state",
+    "AGGREGATE_DIR": None,
+    "REPORT_DAYS": 1,
+    "REPORT_END_DATE": None,
+    "URL_STRIP_QUERY": False,
+    "URL_COLLAPSE_IDS": False,
+    "URL_RULES": [],
+    "MAX_URLS": 0,
+    "GZIP_DECOMPRESSOR": "auto",
+    "USE_MMAP": True,
+    "REPORT_GZIP": False,
+    "REPORT_SIDE_FILES": [],
+    "INDEX_FILE": "./log_analyzer.index.json",
+    "BACKFILL": False,
+    "WORKER_MEMORY_MB": 0,
+    "COLUMNAR_EXPORT": None,
+    "COLUMNAR_DIR": None,
+    "STATS_ENGINE": "aggregate",
 }
 
+READ_BLOCK_SIZE = 1 << 20
+
+DECOMPRESS_COMMANDS = {"pigz": ["pigz", "-dc"], "zcat": ["zcat"]}
+
+OTHER_URL = b"(other)"
+
+URL_ID_RULES = (
+    (re.compile(rb"/\d+(?=/|$)"), b"/{id}"),
+    (
+        re.compile(
+            rb"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+            rb"(?=/|$)"
+        ),
+        b"/{uuid}",
+    ),
+)
+
+SKETCH_PERCENTILES = (90, 95, 99)
+
+GZIP_BATCH_LINES = 50_000
+
+LOG_NAME_RE = re.compile(r"nginx-access-ui\.log-(\d{8})(\.gz)?")
+
+LOG_LINE_RE = re.compile(rb'[^"]*"\w{2,6} (/[^"]*) HTTP/\d\.\d"(?: (\d+))?')
+
+COLUMNS_DTYPE = [("url_id", "<u4"), ("request_time", "<f8"), ("status", "<u2")]
+
+Log = namedtuple("Log", "date filename path file_type")
+
+RawData = namedtuple(
+    "RawData",
+    "total_urls_count total_request_time errors urls_stat columns",
+    defaults=(None,),
+)
+
+
+class Columns:
+    """Per-request url ids, request times and statuses for the columnar export."""
+
+    __slots__ = ("url_ids_by_url", "url_ids", "request_times", "statuses")
+
+    def __init__(self) -> None:
+        self.url_ids_by_url = {}
+        self.url_ids = array("I")
+        self.request_times = array("d")
+        self.statuses = array("H")
+
+    def add(self, url: bytes, request_time: float, status: int) -> None:
+        url_id = self.url_ids_by_url.get(url)
+        if url_id is None:
+            url_id = self.url_ids_by_url[url] = len(self.url_ids_by_url)
+        self.url_ids.append(url_id)
+        self.request_times.append(request_time)
+        self.statuses.append(status)
+
+    def merge(self, other: "Columns", max_urls: int = 0) -> None:
+        """Append the requests of `other`, new urls beyond max_urls go to OTHER_URL."""
+        remap = array("I", bytes(4 * len(other.url_ids_by_url)))
+        for url, url_id in other.url_ids_by_url.items():
+            own_id = self.url_ids_by_url.get(url)
+            if own_id is None and max_urls and len(self.url_ids_by_url) >= max_urls:
+                url = OTHER_URL
+                own_id = self.url_ids_by_url.get(url)
+            if own_id is None:
+                own_id = self.url_ids_by_url[url] = len(self.url_ids_by_url)
+            remap[url_id] = own_id
+        self.url_ids.extend(remap[url_id] for url_id in other.url_ids)
+        self.request_times.extend(other.request_times)
+        self.statuses.extend(other.statuses)
+
+    def urls(self) -> list:
+        return sorted(self.url_ids_by_url, key=self.url_ids_by_url.get)
+
+
+class ExactQuantiles:
+    """Exact quantiles over a millisecond histogram of request times.
+
+    nginx logs $request_time with ms resolution, so counting hits per
+    millisecond keeps the answer exact while memory depends only on the
+    number of distinct timings.
+    """
+
+    __slots__ = ("count", "hist")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.hist = {}
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        ms = round(value * 1000)
+        self.hist[ms] = self.hist.get(ms, 0) + 1
+
+    def merge(self, other: "ExactQuantiles") -> None:
+        self.count += other.count
+        for ms, hits in other.hist.items():
+            self.hist[ms] = self.hist.get(ms, 0) + hits
+
+    def dump(self) -> tuple:
+        return ("exact", self.hist)
+
+    @classmethod
+    def load(cls, state: tuple) -> "ExactQuantiles":
+        quantiles = cls()
+        quantiles.hist = state[1]
+        quantiles.count = sum(quantiles.hist.values())
+        return quantiles
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        position = q * (self.count - 1)
+        left, right = int(position), min(int(position) + 1, self.count - 1)
+        fraction = position - left
+        seen = 0
+        low = None
+        for ms in sorted(self.hist):
+            seen += self.hist[ms]
+            if low is None and seen > left:
+                low = ms / 1000
+            if seen > right:
+                return low * (1 - fraction) + ms / 1000 * fraction
+        return low
+
+
+class TDigest:
+    """Merging t-digest (Dunning) with the k1 scale function.
+
+    Keeps at most ~compression centroids, so memory per url is constant
+    and digests from different workers or days can be merged. Quantile
+    error is roughly proportional to q * (1 - q) / compression.
+    """
+
+    __slots__ = ("compression", "means", "weights", "buffer", "count", "min", "max")
+
+    def __init__(self, compression: int = 100) -> None:
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.buffer.append((value, 1))
+        if len(self.buffer) >= self.compression * 4:
+            self._compress()
+
+    def merge(self, other: "TDigest") -> None:
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buffer.extend(zip(other.means, other.weights))
+        self.buffer.extend(other.buffer)
+        if len(self.buffer) >= self.compression * 4:
+            self._compress()
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _k_inverse(self, k: float) -> float:
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2)) + 1) / 2
+
+    def _compress(self) -> None:
+        if not self.buffer:
+            return
+        centroids = sorted(self.buffer + list(zip(self.means, self.weights)))
+        self.buffer = []
+        means, weights = [], []
+        total = self.count
+        merged = 0
+        q_limit = self._k_inverse(self._k(0) + 1) * total
+        mean, weight = centroids[0]
+        for next_mean, next_weight in centroids[1:]:
+            if merged + weight + next_weight <= q_limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                merged += weight
+                q_limit = self._k_inverse(self._k(merged / total) + 1) * total
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def dump(self) -> tuple:
+        self._compress()
+        return (
+            "sketch",
+            self.compression,
+            self.means,
+            self.weights,
+            self.min,
+            self.max,
+        )
+
+    @classmethod
+    def load(cls, state: tuple) -> "TDigest":
+        digest = cls(state[1])
+        digest.means, digest.weights, digest.min, digest.max = state[2:]
+        digest.count = sum(digest.weights)
+        return digest
+
+    def quantile(self, q: float) -> float:
+        self._compress()
+        if not self.means:
+            return 0.0
+        means, weights = self.means, self.weights
+        target = q * self.count
+        if target < weights[0] / 2:
+            if weights[0] == 1:
+                return self.min
+            return self.min + (means[0] - self.min) * target / (weights[0] / 2)
+        cumulative = 0
+        for i in range(len(means) - 1):
+            center = cumulative + weights[i] / 2
+            next_center = cumulative + weights[i] + weights[i + 1] / 2
+            if target <= next_center:
+                fraction = (target - center) / (next_center - center)
+                return means[i] + (means[i + 1] - means[i]) * fraction
+            cumulative += weights[i]
+        center = self.count - weights[-1] / 2
+        if weights[-1] == 1 or target >= self.count:
+            return self.max
+        return means[-1] + (self.max - means[-1]) * (target - center) / (
+            self.count - center
+        )
+
+
+QUANTILE_BACKENDS = {"exact": ExactQuantiles, "sketch": TDigest}
+
+
+def _quantile_factory(_config: dict):
+    mode = _config.get("QUANTILE_MODE", "exact")
+    if mode not in QUANTILE_BACKENDS:
+        raise ValueError(f"Unknown QUANTILE_MODE {mode}")
+    if mode == "sketch":
+        return partial(TDigest, _config.get("QUANTILE_COMPRESSION", 100))
+    return QUANTILE_BACKENDS[mode]
+
+
+class UrlStat:
+    """Running aggregates of request_time for one url."""
+
+    __slots__ = ("count", "time_sum", "time_max", "quantiles")
+
+    def __init__(self, quantiles) -> None:
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.quantiles = quantiles
+
+    def add(self, request_time: float) -> None:
+        self.count += 1
+        self.time_sum += request_time
+        if request_time > self.time_max:
+            self.time_max = request_time
+        self.quantiles.add(request_time)
+
+    def merge(self, other: "UrlStat") -> None:
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        self.quantiles.merge(other.quantiles)
+
+    def dump(self) -> tuple:
+        return (self.count, self.time_sum, self.time_max, self.quantiles.dump())
+
+    @classmethod
+    def load(cls, state: tuple) -> "UrlStat":
+        quantiles = QUANTILE_BACKENDS[state[3][0]].load(state[3])
+        stat = cls(quantiles)
+        stat.count, stat.time_sum, stat.time_max = state[:3]
+        return stat
+
+
+def _split_lines(blocks: Iterable[bytes]) -> Iterator[list]:
+    tail = b""
+    for block in blocks:
+        lines = (tail + block).split(b"\n")
+        tail = lines.pop()
+        if lines:
+            yield lines
+    if tail:
+        yield [tail]
+
 
-def _read_log(file_path: str, file_encoding: str = "utf-8"):
-    with (
-        gzip.open(file_path, "r")
-        if file_path.endswith(".gz")
-        else open(file_path, "r", encoding=file_encoding)
-    ) as f:
-        line = f.readline()
-        while line:
-            yield line.decode()
-            line = f.readline()
+def _file_blocks(f, limit: Union[int, None] = None) -> Iterator[bytes]:
+    while limit is None or limit > 0:
+        block = f.read(
+            READ_BLOCK_SIZE if limit is None else min(READ_BLOCK_SIZE, limit)
+        )
+        if not block:
+            break
+        if limit is not None:
+            limit -= len(block)
+        yield block
+
+
+def _gzip_blocks(file_path: str) -> Iterator[bytes]:
+    with open(file_path, "rb") as f:
+        decompressor = zlib.decompressobj(wbits=31)
+        in_member = False
+        for block in _file_blocks(f):
+            while block:
+                in_member = True
+                yield decompressor.decompress(block)
+                block = b""
+                if decompressor.eof:
+                    # concatenated gzip members, e.g. after `cat a.gz b.gz`
+                    block = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+                    in_member = False
+        if in_member:
+            raise EOFError(f"{file_path} ended before the end-of-stream marker")
+
+
+def _pipe_blocks(command: list, file_path: str) -> Iterator[bytes]:
+    with subprocess.Popen([*command, file_path], stdout=subprocess.PIPE) as process:
+        yield from _file_blocks(process.stdout)
+    if process.returncode != 0:
+        raise OSError(f"{command[0]} failed to decompress {file_path}")
+
+
+def _log_blocks(file_path: str, decompressor: str) -> Iterator[bytes]:
+    if not file_path.endswith(".gz"):
+        with open(file_path, "rb") as f:
+            yield from _file_blocks(f)
+        return
+    if decompressor == "auto":
+        decompressor = "pigz" if shutil.which("pigz") else "python"
+    if decompressor == "python":
+        yield from _gzip_blocks(file_path)
+    elif decompressor in DECOMPRESS_COMMANDS:
+        yield from _pipe_blocks(DECOMPRESS_COMMANDS[decompressor], file_path)
+    else:
+        raise ValueError(f"Unknown GZIP_DECOMPRESSOR {decompressor}")
+
+
+def _read_log(file_path: str, decompressor: str = "python") -> Iterator[bytes]:
+    yield from chain.from_iterable(_split_lines(_log_blocks(file_path, decompressor)))
     logging.info(f"Data successfully read from {file_path}")
 
 
-def _find_newest_log(_config: dict) -> Union[namedtuple, None]:
-    Log = namedtuple("Log", "date filename path file_type")
-    log = Log(datetime.now().date().min, "", "", "")
-    files = os.listdir(_config["LOG_DIR"])
-    for filename in files:
-        regex = re.findall(r"^nginx-access-ui.log-(\d{8})(\.gz)?$", filename)
-        if len(regex) > 0:
-            file_date = datetime.strptime(regex[0][0], "%Y%m%d").date()
-            if log.date < file_date:
-                log = Log(
-                    file_date, filename, f'{_config["LOG_DIR"]}/{filename}', regex[0][1]
+def _read_chunk(file_path: str, start: int, end: int) -> Iterator[bytes]:
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        yield from chain.from_iterable(_split_lines(_file_blocks(f, end - start)))
+
+
+def _last_line_end(file_path: str, size: int) -> int:
+    """Offset right after the last complete line, a partial tail is left for later."""
+    with open(file_path, "rb") as f:
+        position = size
+        while position > 0:
+            block_start = max(position - 65536, 0)
+            f.seek(block_start)
+            newline = f.read(position - block_start).rfind(b"\n")
+            if newline != -1:
+                return block_start + newline + 1
+            position = block_start
+    return 0
+
+
+def _split_log(file_path: str, parts: int, start: int = 0, end: int = None) -> list:
+    """Newline-aligned [start, end) byte ranges; workers map the file themselves."""
+    end = os.path.getsize(file_path) if end is None else end
+    if end <= start:
+        return []
+    bounds = [start]
+    with open(file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for i in range(1, parts):
+                approx = max(start + (end - start) * i // parts, bounds[-1])
+                newline = buffer.find(b"\n", approx, end)
+                bounds.append(end if newline == -1 else newline + 1)
+    bounds.append(end)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def _scan_logs(log_dir: str) -> dict:
+    logs = {}
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            match = LOG_NAME_RE.fullmatch(entry.name)
+            if match is None:
+                continue
+            day = match.group(1)
+            try:
+                file_date = date(int(day[:4]), int(day[4:6]), int(day[6:]))
+            except ValueError:
+                continue
+            if file_date not in logs:
+                logs[file_date] = Log(
+                    file_date,
+                    entry.name,
+                    f"{log_dir}/{entry.name}",
+                    match.group(2) or "",
                 )
+    return logs
+
+
+def _scan_reports(report_dir: str) -> set:
+    with os.scandir(report_dir) as entries:
+        return {entry.name for entry in entries if entry.name.startswith("report-")}
+
+
+def _load_index(_config: dict) -> dict:
+    path = _config.get("INDEX_FILE")
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Index file {path} is broken, rescanning: {e}")
+        return {}
+
+
+def _save_index(index: dict, _config: dict) -> None:
+    # rewritten in place: creating a new file would bump the mtime of its directory
+    try:
+        with open(_config["INDEX_FILE"], "w") as f:
+            json.dump(index, f)
+    except OSError as e:
+        logging.warning(f"Cannot save index file {_config['INDEX_FILE']}: {e}")
+
+
+def _cached_scan(section: str, directory: str, scan: Callable, _config: dict):
+    """Listing of `directory`, cached in INDEX_FILE until the directory mtime changes."""
+    if not _config.get("INDEX_FILE"):
+        return scan(directory)
+    mtime = os.stat(directory).st_mtime_ns
+    index = _load_index(_config)
+    cached = index.get(section)
+    if cached and cached["path"] == directory and cached["mtime"] == mtime:
+        return cached["entries"]
+    entries = scan(directory)
+    index[section] = {"path": directory, "mtime": mtime, "entries": entries}
+    _save_index(index, _config)
+    return entries
+
+
+def _find_logs(_config: dict) -> dict:
+    def scan(log_dir: str) -> list:
+        return [
+            [log.date.isoformat(), log.filename, log.file_type]
+            for log in _scan_logs(log_dir).values()
+        ]
+
+    logs = {}
+    for day, filename, file_type in _cached_scan(
+        "logs", _config["LOG_DIR"], scan, _config
+    ):
+        file_date = date.fromisoformat(day)
+        logs[file_date] = Log(
+            file_date, filename, f'{_config["LOG_DIR"]}/{filename}', file_type
+        )
+    return logs
+
+
+def _built_reports(_config: dict) -> set:
+    def scan(report_dir: str) -> list:
+        return sorted(_scan_reports(report_dir))
+
+    return set(_cached_scan("reports", _config["REPORT_DIR"], scan, _config))
+
+
+def _report_exists(name: str, _config: dict) -> bool:
+    return name in _built_reports(_config)
+
+
+def _find_newest_log(_config: dict) -> Union[namedtuple, None]:
+    logs = _find_logs(_config)
+    if not logs:
+        logging.info("Find newest log - ")
+        return None
+    log = logs[max(logs)]
     logging.info(f"Find newest log - {log.filename}")
-    if log.date == datetime.now().date().min:
+    return log
+
+
+def _parse_line(line: bytes) -> Union[tuple, None]:
+    match = LOG_LINE_RE.match(line)
+    if match is None:
         return None
-    else:
-        return log
+    try:
+        request_time = float(line[line.rindex(b" ") + 1 :])
+    except ValueError:
+        return None
+    url, status = match.groups()
+    return url, request_time, status
 
 
-def _get_prepared_data(log: namedtuple, _config: dict) -> namedtuple:
-    RawData = namedtuple(
-        "RawData", "total_urls_count total_request_time errors urls_stat"
-    )
+def _parse_mmap(buffer, start: int, end: int) -> Iterator[Union[tuple, None]]:
+    """Same as _parse_line for every line of buffer[start:end], without copying lines."""
+    match_line = LOG_LINE_RE.match
+    find, rfind = buffer.find, buffer.rfind
+    while start < end:
+        line_end = find(b"\n", start, end)
+        if line_end == -1:
+            line_end = end
+        match = match_line(buffer, start, line_end)
+        if match is None:
+            yield None
+        else:
+            try:
+                request_time = float(
+                    buffer[rfind(b" ", start, line_end) + 1 : line_end]
+                )
+                url, status = match.groups()
+                yield url, request_time, status
+            except ValueError:
+                yield None
+        start = line_end + 1
+
+
+def _url_normalizer(_config: dict) -> Union[Callable, None]:
+    strip_query = _config.get("URL_STRIP_QUERY", False)
+    rules = list(URL_ID_RULES) if _config.get("URL_COLLAPSE_IDS", False) else []
+    rules += [
+        (re.compile(pattern.encode()), repl.encode())
+        for pattern, repl in _config.get("URL_RULES", [])
+    ]
+    if not strip_query and not rules:
+        return None
+
+    def normalize(url: bytes) -> bytes:
+        path, sep, query = url.partition(b"?")
+        for pattern, repl in rules:
+            path = pattern.sub(repl, path)
+        return path if strip_query else path + sep + query
+
+    return normalize
+
+
+def _aggregate(lines: Iterable[bytes], _config: dict) -> RawData:
+    return _aggregate_parsed(map(_parse_line, lines), _config)
+
+
+def _aggregate_parsed(records: Iterable[Union[tuple, None]], _config: dict) -> RawData:
+    if _config.get("STATS_ENGINE") == "numpy":
+        return _collect_columns(records, _config)
+    make_quantiles = _quantile_factory(_config)
+    normalize = _url_normalizer(_config)
+    max_urls = _config.get("MAX_URLS", 0)
     total_urls_count = 0
     total_request_time = 0
     errors = 0
     urls_stat = {}
+    columns = Columns() if _config.get("COLUMNAR_EXPORT") else None
 
-    log_file = _read_log(log.path)
-    for line in log_file:
-        regex = re.findall(r"^.* \"\w{2,6} (\/.*) HTTP/\d\.\d\".* (\d*\.\d*)$", line)
-        if len(regex) > 0 and len(regex[0]) == 2:
-            if regex[0][0] not in urls_stat.keys():
-                urls_stat[regex[0][0]] = []
-            urls_stat[regex[0][0]].append(float(regex[0][1]))
-            total_request_time += float(regex[0][1])
-            total_urls_count += 1
-        else:
+    for parsed in records:
+        if parsed is None:
+            errors += 1
+            continue
+        url, request_time, status = parsed
+        if normalize is not None:
+            url = normalize(url)
+        stat = urls_stat.get(url)
+        if stat is None:
+            if max_urls and len(urls_stat) >= max_urls:
+                url = OTHER_URL
+                stat = urls_stat.get(url)
+            if stat is None:
+                stat = urls_stat[url] = UrlStat(make_quantiles())
+        stat.add(request_time)
+        if columns is not None:
+            columns.add(url, request_time, int(status) if status else 0)
+        total_request_time += request_time
+        total_urls_count += 1
+    return RawData(total_urls_count, total_request_time, errors, urls_stat, columns)
+
+
+def _collect_columns(records: Iterable[Union[tuple, None]], _config: dict) -> RawData:
+    """Only append url ids and times, the stats come from _calculate_stat_vectorized."""
+    normalize = _url_normalizer(_config)
+    max_urls = _config.get("MAX_URLS", 0)
+    errors = 0
+    columns = Columns()
+    url_ids_by_url = columns.url_ids_by_url
+    add_url_id = columns.url_ids.append
+    add_request_time = columns.request_times.append
+    add_status = columns.statuses.append
+
+    for parsed in records:
+        if parsed is None:
             errors += 1
-    logging.info(f"Data prepared with url count - {total_urls_count}")
-    return RawData(total_urls_count, total_request_time, errors, urls_stat)
+            continue
+        url, request_time, status = parsed
+        if normalize is not None:
+            url = normalize(url)
+        url_id = url_ids_by_url.get(url)
+        if url_id is None:
+            if max_urls and len(url_ids_by_url) >= max_urls:
+                url = OTHER_URL
+                url_id = url_ids_by_url.get(url)
+            if url_id is None:
+                url_id = url_ids_by_url[url] = len(url_ids_by_url)
+        add_url_id(url_id)
+        add_request_time(request_time)
+        add_status(int(status) if status else 0)
+    # summed in log order, exactly like the running total of _aggregate_parsed
+    total_request_time = sum(columns.request_times)
+    return RawData(len(columns.url_ids), total_request_time, errors, {}, columns)
+
+
+def _aggregate_chunk(file_path: str, start: int, end: int, _config: dict) -> RawData:
+    if not _config.get("USE_MMAP", True) or end <= start:
+        return _aggregate(_read_chunk(file_path, start, end), _config)
+    with open(file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+            return _aggregate_parsed(_parse_mmap(buffer, start, end), _config)
+
+
+def _merge_raw_data(target: RawData, part: RawData, max_urls: int = 0) -> RawData:
+    urls_stat = target.urls_stat
+    for url, stat in part.urls_stat.items():
+        current = urls_stat.get(url)
+        if current is None and max_urls and len(urls_stat) >= max_urls:
+            current = urls_stat.get(OTHER_URL)
+            url = OTHER_URL
+        if current is None:
+            urls_stat[url] = stat
+        else:
+            current.merge(stat)
+    columns = target.columns
+    if columns is None:
+        columns = part.columns
+    elif part.columns is not None:
+        columns.merge(part.columns, max_urls)
+    return RawData(
+        target.total_urls_count + part.total_urls_count,
+        target.total_request_time + part.total_request_time,
+        target.errors + part.errors,
+        urls_stat,
+        columns,
+    )
+
+
+def _aggregate_parallel(
+    log: namedtuple, workers: int, _config: dict, start: int = 0, end: int = None
+) -> RawData:
+    raw_data = RawData(0, 0, 0, {})
+    max_urls = _config.get("MAX_URLS", 0)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if log.file_type == ".gz":
+            # gzip can't be split by offset: decompress here and fan out line batches
+            pending = deque()
+            lines = _read_log(log.path, _config.get("GZIP_DECOMPRESSOR", "auto"))
+            while batch := list(islice(lines, GZIP_BATCH_LINES)):
+                if len(pending) >= workers * 2:
+                    # merge in log order, so the urls kept under MAX_URLS and
+                    # ties in the report do not depend on worker timing
+                    part = pending.popleft().result()
+                    raw_data = _merge_raw_data(raw_data, part, max_urls)
+                pending.append(executor.submit(_aggregate, batch, _config))
+        else:
+            pending = deque(
+                executor.submit(
+                    _aggregate_chunk, log.path, chunk_start, chunk_end, _config
+                )
+                for chunk_start, chunk_end in _split_log(log.path, workers, start, end)
+            )
+        for future in pending:
+            raw_data = _merge_raw_data(raw_data, future.result(), max_urls)
+    return raw_data
+
+
+def _get_prepared_data(log: namedtuple, _config: dict) -> RawData:
+    workers = _config.get("WORKERS", 1)
+    if workers > 1:
+        raw_data = _aggregate_parallel(log, workers, _config)
+    elif log.file_type != ".gz":
+        raw_data = _aggregate_chunk(log.path, 0, os.path.getsize(log.path), _config)
+    else:
+        lines = _read_log(log.path, _config.get("GZIP_DECOMPRESSOR", "auto"))
+        raw_data = _aggregate(lines, _config)
+    logging.info(f"Data prepared with url count - {raw_data.total_urls_count}")
+    if raw_data.columns is not None and _config.get("COLUMNAR_EXPORT"):
+        _write_columns(raw_data.columns, log, _config)
+    return raw_data
+
+
+def _write_columns(columns: Columns, log: namedtuple, _config: dict) -> None:
+    export_format = _config["COLUMNAR_EXPORT"]
+    base = f'{_config.get("COLUMNAR_DIR") or _config["REPORT_DIR"]}/requests-{log.date}'
+    if export_format == "npy":
+        if np is None:
+            logging.error("COLUMNAR_EXPORT npy needs numpy, export skipped")
+            return
+        table = np.empty(len(columns.url_ids), dtype=COLUMNS_DTYPE)
+        table["url_id"] = np.frombuffer(columns.url_ids, dtype=np.uint32)
+        table["request_time"] = np.frombuffer(columns.request_times, dtype=np.float64)
+        table["status"] = np.frombuffer(columns.statuses, dtype=np.uint16)
+        with _atomic_file(f"{base}.npy", open, "wb") as f:
+            np.save(f, table)
+    elif export_format == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            logging.error("COLUMNAR_EXPORT parquet needs pyarrow, export skipped")
+            return
+        table = pa.table(
+            {
+                "url_id": pa.array(columns.url_ids, type=pa.uint32()),
+                "request_time": pa.array(columns.request_times, type=pa.float64()),
+                "status": pa.array(columns.statuses, type=pa.uint16()),
+            }
+        )
+        with _atomic_file(f"{base}.parquet", open, "wb") as f:
+            pq.write_table(table, f)
+    else:
+        raise ValueError(f"Unknown COLUMNAR_EXPORT {export_format}")
+    with _atomic_file(f"{base}.urls.json", open, "w", encoding="utf-8") as f:
+        json.dump([url.decode("utf-8", "replace") for url in columns.urls()], f)
+    logging.info(f"Requests exported to {base}.{export_format}")
+
+
+def load_columns(path: str) -> tuple:
+    """Load a columnar export: (per-request table, urls indexed by url_id)."""
+    base, export_format = path.rsplit(".", 1)
+    with open(f"{base}.urls.json", "r", encoding="utf-8") as f:
+        urls = json.load(f)
+    if export_format == "npy":
+        return np.load(path), urls
+    import pyarrow.parquet as pq
+
+    return pq.read_table(path), urls
 
 
 def _calculate_stat(
     total_urls_count: int, total_request_time: float, urls_stat: dict, _config: dict
 ) -> list:
     report = []
-    for url in urls_stat.keys():
+    sketch = _config.get("QUANTILE_MODE", "exact") == "sketch"
+    # only the REPORT_SIZE slowest urls get their full row materialized
+    top = heapq.nlargest(
+        _config["REPORT_SIZE"], urls_stat.items(), key=lambda item: item[1].time_sum
+    )
+    for url, stat in top:
+        row = {
+            "count": stat.count,
+            "time_avg": round(stat.time_sum / stat.count, 3),
+            "time_max": round(stat.time_max, 3),
+            "time_sum": round(stat.time_sum, 3),
+            "url": url.decode("utf-8", "replace"),
+            "time_med": round(stat.quantiles.quantile(0.5), 3),
+            "time_perc": round(stat.time_sum / total_request_time * 100, 3),
+            "count_perc": round(stat.count / total_urls_count * 100, 3),
+        }
+        if sketch:
+            for percentile in SKETCH_PERCENTILES:
+                value = stat.quantiles.quantile(percentile / 100)
+                row[f"time_p{percentile}"] = round(value, 3)
+        report.append(row)
+    logging.info(f"Report completed and sorted")
+    return report
+
+
+def _calculate_stat_vectorized(
+    total_urls_count: int, total_request_time: float, columns: Columns, _config: dict
+) -> list:
+    url_ids = np.frombuffer(columns.url_ids, dtype=np.uint32)
+    request_times = np.frombuffer(columns.request_times, dtype=np.float64)
+    urls = columns.urls()
+    # bincount adds the weights in log order, so sums match UrlStat.time_sum exactly
+    counts = np.bincount(url_ids, minlength=len(urls))
+    time_sums = np.bincount(url_ids, weights=request_times, minlength=len(urls))
+    # one sort by (url id, request time) gives every group its max and median
+    order = np.lexsort((request_times, url_ids))
+    sorted_times = request_times[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    time_maxes = sorted_times[starts + counts - 1]
+    time_meds = (
+        sorted_times[starts + (counts - 1) // 2] + sorted_times[starts + counts // 2]
+    ) / 2
+    # stable sort keeps first-seen order between equal sums, as heapq.nlargest does
+    top = np.argsort(-time_sums, kind="stable")[: _config["REPORT_SIZE"]]
+
+    report = []
+    for url_id in top.tolist():
+        count = int(counts[url_id])
+        time_sum = float(time_sums[url_id])
         report.append(
             {
-                "count": len(urls_stat[url]),
-                "time_avg": round(statistics.fmean(urls_stat[url]), 3),
-                "time_max": round(max(urls_stat[url]), 3),
-                "time_sum": round(sum(urls_stat[url]), 3),
-                "url": url,
-                "time_med": round(statistics.median(urls_stat[url]), 3),
-                "time_perc": round(sum(urls_stat[url]) / total_request_time * 100, 3),
-                "count_perc": round(len(urls_stat[url]) / total_urls_count * 100, 3),
+                "count": count,
+                "time_avg": round(time_sum / count, 3),
+                "time_max": round(float(time_maxes[url_id]), 3),
+                "time_sum": round(time_sum, 3),
+                "url": urls[url_id].decode("utf-8", "replace"),
+                "time_med": round(float(time_meds[url_id]), 3),
+                "time_perc": round(time_sum / total_request_time * 100, 3),
+                "count_perc": round(count / total_urls_count * 100, 3),
             }
         )
-    report.sort(key=lambda x: x["time_sum"], reverse=True)
     logging.info(f"Report completed and sorted")
-    if len(report) >= _config["REPORT_SIZE"]:
-        return report[0 : _config["REPORT_SIZE"]]
     return report
 
 
+def _report_rows(raw_data: RawData, _config: dict) -> list:
+    if _config.get("STATS_ENGINE") == "numpy":
+        return _calculate_stat_vectorized(
+            raw_data.total_urls_count,
+            raw_data.total_request_time,
+            raw_data.columns,
+            _config,
+        )
+    return _calculate_stat(
+        raw_data.total_urls_count,
+        raw_data.total_request_time,
+        raw_data.urls_stat,
+        _config,
+    )
+
+
+def _report_name(report_date: date, _config: dict) -> str:
+    days = _config.get("REPORT_DAYS", 1)
+    if days > 1:
+        return f"report-{report_date}-{days}d.html"
+    return f"report-{report_date}.html"
+
+
+def _json_rows(report: Iterable[dict]) -> Iterator[str]:
+    """Same text as json.dumps(report), produced row by row."""
+    yield "["
+    for i, row in enumerate(report):
+        yield json.dumps(row) if i == 0 else ", " + json.dumps(row)
+    yield "]"
+
+
+@contextmanager
+def _atomic_file(path: str, opener: Callable, *args, **kwargs):
+    """Write to a temporary file and move it over `path` only when done."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with opener(tmp_path, *args, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def _write_report(report: list, log: namedtuple, _config: dict) -> None:
     with open(f'{_config["REPORT_DIR"]}/report-template.html', "r") as f:
-        raw = f.read()
-    template = string.Template(raw)
-    data = template.safe_substitute(table_json=json.dumps(report))
-    with open(f'{_config["REPORT_DIR"]}/report-{log.date}.html', "w") as f:
-        f.write(data)
-    logging.info(f'Report created at {_config["REPORT_DIR"]}/report-{log.date}.html')
+        prefix, placeholder, suffix = f.read().partition("$table_json")
+    if not placeholder:
+        raise ValueError("Report template has no $table_json placeholder")
+    path = f'{_config["REPORT_DIR"]}/{_report_name(log.date, _config)}'
+    with ExitStack() as stack:
+        sinks = [stack.enter_context(_atomic_file(path, open, "w", encoding="utf-8"))]
+        if _config.get("REPORT_GZIP", False):
+            sinks.append(
+                stack.enter_context(
+                    _atomic_file(f"{path}.gz", gzip.open, "wt", encoding="utf-8")
+                )
+            )
+        json_sinks = []
+        if "json" in _config.get("REPORT_SIDE_FILES", []):
+            json_path = f"{path.removesuffix('.html')}.json"
+            json_sinks.append(
+                stack.enter_context(
+                    _atomic_file(json_path, open, "w", encoding="utf-8")
+                )
+            )
+        for sink in sinks:
+            sink.write(prefix)
+        for chunk in _json_rows(report):
+            for sink in sinks + json_sinks:
+                sink.write(chunk)
+        for sink in sinks:
+            sink.write(suffix)
+    if "csv" in _config.get("REPORT_SIDE_FILES", []) and report:
+        csv_path = f"{path.removesuffix('.html')}.csv"
+        with _atomic_file(csv_path, open, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(report[0]))
+            writer.writeheader()
+            writer.writerows(report)
+    logging.info(f"Report created at {path}")
+
+
+def _dump_raw_data(raw_data: RawData) -> tuple:
+    urls_stat = {url: stat.dump() for url, stat in raw_data.urls_stat.items()}
+    return (*raw_data[:3], urls_stat)
+
+
+def _load_raw_data(state: tuple) -> RawData:
+    urls_stat = {url: UrlStat.load(stat) for url, stat in state[3].items()}
+    return RawData(*state[:3], urls_stat)
+
+
+def _aggregation_settings(_config: dict) -> tuple:
+    """Config that shapes stored aggregates, they are rebuilt when it changes."""
+    return (
+        _config.get("QUANTILE_MODE", "exact"),
+        _config.get("QUANTILE_COMPRESSION", 100),
+        _config.get("URL_STRIP_QUERY", False),
+        _config.get("URL_COLLAPSE_IDS", False),
+        [tuple(rule) for rule in _config.get("URL_RULES", [])],
+        _config.get("MAX_URLS", 0),
+    )
+
+
+def _aggregate_path(log: namedtuple, _config: dict) -> str:
+    return f'{_config["AGGREGATE_DIR"]}/aggregate-{log.date}.bin'
+
+
+def _get_day_data(log: namedtuple, _config: dict) -> RawData:
+    """Per-day aggregates, loaded from AGGREGATE_DIR when still valid for the log."""
+    if not _config.get("AGGREGATE_DIR"):
+        return _get_prepared_data(log, _config)
+    file_stat = os.stat(log.path)
+    source = (log.filename, file_stat.st_size, file_stat.st_mtime_ns)
+    settings = _aggregation_settings(_config)
+    path = _aggregate_path(log, _config)
+    if os.path.exists(path):
+        try:
+            with gzip.open(path, "rb") as f:
+                saved = pickle.load(f)
+            if saved["source"] == source and saved["settings"] == settings:
+                logging.info(f"Aggregates for {log.date} loaded from {path}")
+                return _load_raw_data(saved["raw_data"])
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError) as e:
+            logging.error(f"Aggregate file {path} is broken, parsing the log: {e}")
+    raw_data = _get_prepared_data(log, _config)
+    saved = {
+        "source": source,
+        "settings": settings,
+        "raw_data": _dump_raw_data(raw_data),
+    }
+    with _atomic_file(path, gzip.open, "wb", compresslevel=1) as f:
+        pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return raw_data
+
+
+def _get_window_data(logs: dict, end_date: date, _config: dict) -> RawData:
+    raw_data = RawData(0, 0, 0, {})
+    for day in range(_config["REPORT_DAYS"] - 1, -1, -1):
+        log_date = end_date - timedelta(days=day)
+        if log_date not in logs:
+            logging.warning(f"No log for {log_date}, skipped in the report")
+            continue
+        raw_data = _merge_raw_data(
+            raw_data, _get_day_data(logs[log_date], _config), _config.get("MAX_URLS", 0)
+        )
+    return raw_data
+
+
+def _load_state(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        logging.error(f"State file {path} is broken, starting over: {e}")
+        return {}
+
+
+def _save_state(path: str, state: dict) -> None:
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+
+def _update_incremental(
+    log: namedtuple, entry: Union[dict, None], _config: dict
+) -> tuple:
+    """Parse lines appended to a plain log since the offset stored in `entry`."""
+    file_stat = os.stat(log.path)
+    if (
+        entry is None
+        or entry["inode"] != file_stat.st_ino
+        or entry["offset"] > file_stat.st_size
+    ):
+        entry = {"inode": file_stat.st_ino, "offset": 0, "raw_data": None}
+    end = _last_line_end(log.path, file_stat.st_size)
+    raw_data = RawData(0, 0, 0, {})
+    if entry["raw_data"] is not None:
+        raw_data = _load_raw_data(entry["raw_data"])
+    if end > entry["offset"]:
+        workers = _config.get("WORKERS", 1)
+        if workers > 1:
+            part = _aggregate_parallel(log, workers, _config, entry["offset"], end)
+        else:
+            part = _aggregate_chunk(log.path, entry["offset"], end, _config)
+        raw_data = _merge_raw_data(raw_data, part, _config.get("MAX_URLS", 0))
+        logging.info(f"Parsed {end - entry['offset']} new bytes of {log.filename}")
+    entry = {
+        "inode": file_stat.st_ino,
+        "offset": end,
+        "raw_data": _dump_raw_data(raw_data),
+    }
+    return entry, raw_data
 
 
 def _setup_and_check(default_config: dict) -> dict:
@@ -132,32 +1089,180 @@ def _setup_and_check(default_config: dict) -> dict:
             raise json.JSONDecodeError("Config is invalid", e.doc, e.pos)
         for k, v in imported_config.items():
             new_config[k] = v
+    if "--workers" in sys.argv:
+        if sys.argv.index("--workers") + 1 >= len(sys.argv):
+            raise ValueError("--workers requires a number")
+        new_config["WORKERS"] = int(sys.argv[sys.argv.index("--workers") + 1])
+    if "--backfill" in sys.argv:
+        new_config["BACKFILL"] = True
+    if new_config["WORKERS"] < 1:
+        raise ValueError("WORKERS must be positive")
     if not os.path.isdir(new_config["LOG_DIR"]):
         raise FileNotFoundError("LOG_DIR is invalid")
     if not os.path.isdir(new_config["REPORT_DIR"]):
         os.mkdir(new_config["REPORT_DIR"])
+    if new_config["AGGREGATE_DIR"] and not os.path.isdir(new_config["AGGREGATE_DIR"]):
+        os.mkdir(new_config["AGGREGATE_DIR"])
+    if new_config["REPORT_DAYS"] < 1:
+        raise ValueError("REPORT_DAYS must be positive")
+    if new_config["REPORT_DAYS"] > 1 and not new_config["AGGREGATE_DIR"]:
+        # without it every run parses all logs of the window again
+        raise ValueError("REPORT_DAYS above 1 needs AGGREGATE_DIR")
+    if new_config.get("STATS_ENGINE") == "numpy":
+        if np is None:
+            raise ValueError("STATS_ENGINE numpy needs numpy installed")
+        # the columns engine keeps no per-url aggregates to persist or merge by day
+        if (
+            new_config["INCREMENTAL"]
+            or new_config["AGGREGATE_DIR"]
+            or new_config["REPORT_DAYS"] > 1
+            or new_config["QUANTILE_MODE"] != "exact"
+        ):
+            raise ValueError(
+                "STATS_ENGINE numpy does not support INCREMENTAL, AGGREGATE_DIR, "
+                "REPORT_DAYS or sketch quantiles"
+            )
     return new_config
 
 
+def _build_report(raw_data: RawData, log: namedtuple, _config: dict) -> bool:
+    if raw_data.total_urls_count == 0:
+        logging.error(f"No valid lines in {log.filename}, nothing to report")
+        return False
+    if raw_data.errors / raw_data.total_urls_count * 100 > _config["ERROR_RATE"]:
+        logging.exception("The percentage of errors is more than 51, abort")
+        return False
+    _write_report(_report_rows(raw_data, _config), log, _config)
+    return True
+
+
+def _create_incremental_report(log: namedtuple, _config: dict) -> None:
+    state = _load_state(_config["STATE_FILE"])
+    if state.get("settings") != _aggregation_settings(_config):
+        state = {"settings": _aggregation_settings(_config), "files": {}}
+    files = state["files"]
+    # finish the tail of logs rotated away since the previous run
+    for filename in [name for name in files if name != log.filename]:
+        entry = files.pop(filename)
+        path = f'{_config["LOG_DIR"]}/{filename}'
+        if os.path.exists(path):
+            previous = log._replace(
+                date=datetime.strptime(filename[-8:], "%Y%m%d").date(),
+                filename=filename,
+                path=path,
+            )
+            _, raw_data = _update_incremental(previous, entry, _config)
+            _build_report(raw_data, previous, _config)
+    files[log.filename], raw_data = _update_incremental(
+        log, files.get(log.filename), _config
+    )
+    _save_state(_config["STATE_FILE"], state)
+    _build_report(raw_data, log, _config)
+
+
+def _create_window_report(_config: dict) -> None:
+    logs = _find_logs(_config)
+    if _config.get("REPORT_END_DATE"):
+        end_date = datetime.strptime(_config["REPORT_END_DATE"], "%Y-%m-%d").date()
+    elif logs:
+        end_date = max(logs)
+    else:
+        logging.exception(f"Report doesnt exist")
+        return
+    if _report_exists(_report_name(end_date, _config), _config):
+        logging.exception(f"A report {_report_name(end_date, _config)} already exists")
+        return
+    window = Log(end_date, f'{_config["REPORT_DAYS"]} days to {end_date}', "", "")
+    _build_report(_get_window_data(logs, end_date, _config), window, _config)
+
+
+def _backfill_worker_init(memory_mb: int) -> None:
+    if memory_mb:
+        import resource
+
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _backfill_report(log: namedtuple, _config: dict) -> bool:
+    try:
+        return _build_report(_get_day_data(log, _config), log, _config)
+    except MemoryError:
+        logging.error(f"{log.filename} does not fit into WORKER_MEMORY_MB, skipped")
+        return False
+
+
+def _available_memory() -> Union[int, None]:
+    """MemAvailable in bytes: free memory plus page cache the kernel can drop."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _backfill(_config: dict) -> None:
+    built_reports = _built_reports(_config)
+    logs = [
+        log
+        for log_date, log in sorted(_find_logs(_config).items())
+        if f"report-{log_date}.html" not in built_reports
+    ]
+    if not logs:
+        logging.info("Every log already has a report, nothing to backfill")
+        return
+    memory_mb = _config.get("WORKER_MEMORY_MB", 0)
+    workers = min(_config["WORKERS"], len(logs))
+    available = _available_memory()
+    if memory_mb and available is not None:
+        workers = max(1, min(workers, available // (memory_mb * 1024 * 1024)))
+    # each log is handled by a single process; a mapped log would count
+    # against RLIMIT_AS as a whole, so the budget turns mmap off
+    job_config = {
+        **_config,
+        "WORKERS": 1,
+        "REPORT_DAYS": 1,
+        "USE_MMAP": _config.get("USE_MMAP", True) and not memory_mb,
+    }
+    logging.info(f"Backfilling {len(logs)} logs with {workers} workers")
+    built = 0
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_backfill_worker_init,
+        initargs=(memory_mb,),
+    ) as executor:
+        futures = {
+            executor.submit(_backfill_report, log, job_config): log for log in logs
+        }
+        for future in as_completed(futures):
+            try:
+                built += future.result()
+            except Exception as e:
+                logging.exception(f"Backfill of {futures[future].filename} failed: {e}")
+    logging.info(f"Backfill built {built} of {len(logs)} reports")
+
+
 def create_report(_config: dict):
+    if _config.get("BACKFILL"):
+        _backfill(_config)
+        return
+    if _config.get("REPORT_DAYS", 1) > 1 or _config.get("REPORT_END_DATE"):
+        _create_window_report(_config)
+        return
     log = _find_newest_log(_config)
     if log is None:
         logging.exception(f"Report doesnt exist")
         return
-    if f"report-{log.date}.html" in os.listdir(_config["REPORT_DIR"]):
-        logging.exception(f"A report with date {log.date} already exists")
+    if _config.get("INCREMENTAL") and log.file_type != ".gz":
+        _create_incremental_report(log, _config)
         return
-    raw_data = _get_prepared_data(log, _config)
-    if raw_data.errors / raw_data.total_urls_count * 100 > _config["ERROR_RATE"]:
-        logging.exception("The percentage of errors is more than 51, abort")
+    if _report_exists(f"report-{log.date}.html", _config):
+        logging.exception(f"A report with date {log.date} already exists")
         return
-    report = _calculate_stat(
-        raw_data.total_urls_count,
-        raw_data.total_request_time,
-        raw_data.urls_stat,
-        _config,
-    )
-    _write_report(report, log, _config)
+    _build_report(_get_day_data(log, _config), log, _config)
 
 
 def main() -> None:
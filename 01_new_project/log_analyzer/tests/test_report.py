@@ -1,10 +1,32 @@
+import gzip
+import json
 import os
+import shutil
+import statistics
+import string
+from datetime import date
 
+import pytest
+from src import log_analyzer
 from src.log_analyzer import (
+    OTHER_URL,
+    ExactQuantiles,
+    Log,
+    TDigest,
+    UrlStat,
     _calculate_stat,
+    _find_logs,
     _find_newest_log,
     _get_prepared_data,
+    _get_window_data,
+    _read_log,
+    _report_rows,
+    _setup_and_check,
+    _split_log,
+    _update_incremental,
     _write_report,
+    create_report,
+    load_columns,
 )
 
 _config = {
@@ -15,6 +37,10 @@ _config = {
     "ERROR_RATE": 51,
 }
 
+TEMPLATE = os.path.join(
+    os.path.dirname(__file__), "..", "src", "reports", "report-template.html"
+)
+
 
 def test_create_report() -> None:
     """test_create_report"""
@@ -31,3 +57,415 @@ def test_create_report() -> None:
     assert report[0]["time_avg"], 62.995
     _write_report(report, log, _config)
     assert f"report-{log.date}.html" in os.listdir(_config["REPORT_DIR"])
+
+
+LOG_LINE = (
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" '
+    '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+    '"1498697422-2190034393-4708-9752759" "dc7161be3" {request_time}\n'
+)
+
+SAMPLE = [
+    ("/api/v2/banner/1", "0.390"),
+    ("/api/v2/banner/1", "0.133"),
+    ("/api/v2/banner/1", "0.199"),
+    ("/api/v2/banner/1", "0.704"),
+    ("/api/1/photogenic_banners/list/?server_name=WIN7RB4", "0.146"),
+    ("/api/v2/group/7786679/statistic/sites/?date_type=day", "0.628"),
+    ("/api/v2/group/7786679/statistic/sites/?date_type=day", "1.628"),
+    ("/api/v2/group/7786679/statistic/sites/?date_type=day", "0.067"),
+]
+
+
+def _write_log(path, sample=SAMPLE, broken=0) -> None:
+    with gzip.open(path, "wt") if str(path).endswith(".gz") else open(path, "a") as f:
+        for url, request_time in sample:
+            f.write(LOG_LINE.format(url=url, request_time=request_time))
+        for _ in range(broken):
+            f.write('1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 166 "-" 0.000\n')
+
+
+def _expected_report(sample=SAMPLE) -> list:
+    urls = {}
+    for url, request_time in sample:
+        urls.setdefault(url, []).append(float(request_time))
+    total_count = len(sample)
+    total_time = sum(float(t) for _, t in sample)
+    return {
+        url: {
+            "count": len(times),
+            "time_max": round(max(times), 3),
+            "time_sum": round(sum(times), 3),
+            "time_med": round(statistics.median(times), 3),
+            "time_perc": round(sum(times) / total_time * 100, 3),
+            "count_perc": round(len(times) / total_count * 100, 3),
+        }
+        for url, times in urls.items()
+    }
+
+
+def test_aggregates_match_full_samples(tmp_path) -> None:
+    """test_aggregates_match_full_samples"""
+    _write_log(tmp_path / "nginx-access-ui.log-20170630.gz", broken=2)
+    config = {**_config, "LOG_DIR": str(tmp_path), "REPORT_DIR": str(tmp_path)}
+    raw_data = _get_prepared_data(_find_newest_log(config), config)
+    assert raw_data.total_urls_count == len(SAMPLE)
+    assert raw_data.errors == 2
+    report = _calculate_stat(
+        raw_data.total_urls_count,
+        raw_data.total_request_time,
+        raw_data.urls_stat,
+        config,
+    )
+    expected = _expected_report()
+    assert len(report) == len(expected)
+    for row in report:
+        assert {k: row[k] for k in expected[row["url"]]} == expected[row["url"]]
+
+
+def test_parallel_matches_sequential(tmp_path) -> None:
+    """test_parallel_matches_sequential"""
+    sample = SAMPLE * 500
+    config = {**_config, "LOG_DIR": str(tmp_path), "REPORT_DIR": str(tmp_path)}
+    _write_log(tmp_path / "nginx-access-ui.log-20170629.gz", sample, broken=3)
+    log = _find_newest_log(config)
+    expected = _get_prepared_data(log, config)
+    _write_log(tmp_path / "nginx-access-ui.log-20170630", sample, broken=3)
+    for file_log in (log, _find_newest_log(config)):
+        raw_data = _get_prepared_data(file_log, {**config, "WORKERS": 3})
+        assert raw_data.total_urls_count == expected.total_urls_count
+        assert raw_data.errors == expected.errors
+        assert raw_data.urls_stat.keys() == expected.urls_stat.keys()
+        for url, stat in raw_data.urls_stat.items():
+            assert stat.quantiles.hist == expected.urls_stat[url].quantiles.hist
+
+
+def test_sketch_quantiles_are_close_to_exact() -> None:
+    """test_sketch_quantiles_are_close_to_exact"""
+    values = [round(0.001 * ((i * 7919) % 5000), 3) for i in range(20000)]
+    exact, parts = ExactQuantiles(), [TDigest(100) for _ in range(4)]
+    for i, value in enumerate(values):
+        exact.add(value)
+        parts[i % 4].add(value)
+    for part in parts[1:]:
+        parts[0].merge(part)
+    assert exact.quantile(0.5) == statistics.median(values)
+    for q in (0.5, 0.9, 0.95, 0.99):
+        assert abs(parts[0].quantile(q) - exact.quantile(q)) < 0.05
+
+
+def test_sketch_mode_adds_percentile_columns(tmp_path) -> None:
+    """test_sketch_mode_adds_percentile_columns"""
+    _write_log(tmp_path / "nginx-access-ui.log-20170630.gz")
+    config = {**_config, "LOG_DIR": str(tmp_path), "QUANTILE_MODE": "sketch"}
+    raw_data = _get_prepared_data(_find_newest_log(config), config)
+    report = _calculate_stat(
+        raw_data.total_urls_count,
+        raw_data.total_request_time,
+        raw_data.urls_stat,
+        config,
+    )
+    expected = _expected_report()
+    for row in report:
+        assert row["time_med"] == expected[row["url"]]["time_med"]
+        assert row["time_p90"] <= row["time_p95"] <= row["time_p99"] <= row["time_max"]
+
+
+def test_report_keeps_slowest_urls() -> None:
+    """test_report_keeps_slowest_urls"""
+    urls_stat = {}
+    for i in range(50):
+        stat = urls_stat[f"/api/{i}".encode()] = UrlStat(ExactQuantiles())
+        stat.add((i * 37 % 50) / 10)
+    total = sum(stat.time_sum for stat in urls_stat.values())
+    report = _calculate_stat(50, total, urls_stat, {**_config, "REPORT_SIZE": 5})
+    assert [row["time_sum"] for row in report] == [4.9, 4.8, 4.7, 4.6, 4.5]
+
+
+def test_incremental_parses_only_appended_lines(tmp_path) -> None:
+    """test_incremental_parses_only_appended_lines"""
+    path = tmp_path / "nginx-access-ui.log-20170630"
+    config = {**_config, "LOG_DIR": str(tmp_path), "STATE_FILE": str(tmp_path / "s")}
+    partial_line = LOG_LINE.format(url="/partial", request_time="0.100")
+    _write_log(path, SAMPLE[:3])
+    with open(path, "a") as f:
+        f.write(partial_line[:40])
+    log = _find_newest_log(config)
+    entry, raw_data = _update_incremental(log, None, config)
+    assert raw_data.total_urls_count == 3
+    assert entry["offset"] < os.path.getsize(path)
+    with open(path, "a") as f:
+        f.write(partial_line[40:])
+    _write_log(path, SAMPLE)
+    entry, raw_data = _update_incremental(log, entry, config)
+    assert raw_data.total_urls_count == 4 + len(SAMPLE)
+    assert raw_data.urls_stat[b"/partial"].count == 1
+    assert entry["offset"] == os.path.getsize(path)
+    entry, raw_data = _update_incremental(log, entry, config)
+    assert raw_data.total_urls_count == 4 + len(SAMPLE)
+    assert raw_data.urls_stat[b"/api/v2/banner/1"].quantiles.hist == {
+        390: 2,
+        133: 2,
+        199: 2,
+        704: 1,
+    }
+
+
+def test_rolling_window_merges_daily_aggregates(tmp_path) -> None:
+    """test_rolling_window_merges_daily_aggregates"""
+    for day in ("20170628", "20170629", "20170630"):
+        _write_log(tmp_path / f"nginx-access-ui.log-{day}.gz")
+    config = {
+        **_config,
+        "LOG_DIR": str(tmp_path),
+        "AGGREGATE_DIR": str(tmp_path),
+        "REPORT_DAYS": 2,
+    }
+    logs = _find_logs(config)
+    end_date = max(logs)
+    raw_data = _get_window_data(logs, end_date, config)
+    assert raw_data.total_urls_count == 2 * len(SAMPLE)
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".bin")) == [
+        "aggregate-2017-06-29.bin",
+        "aggregate-2017-06-30.bin",
+    ]
+    cached = _get_window_data(logs, end_date, config)
+    assert cached.total_urls_count == raw_data.total_urls_count
+    for url, stat in cached.urls_stat.items():
+        assert stat.quantiles.hist == raw_data.urls_stat[url].quantiles.hist
+
+
+def test_window_needs_aggregate_dir(tmp_path, monkeypatch) -> None:
+    """test_window_needs_aggregate_dir"""
+    monkeypatch.setattr("sys.argv", ["log_analyzer.py"])
+    config = {
+        **log_analyzer.config,
+        "LOG_DIR": str(tmp_path),
+        "REPORT_DIR": str(tmp_path / "reports"),
+        "REPORT_DAYS": 7,
+    }
+    with pytest.raises(ValueError):
+        _setup_and_check(config)
+    config["AGGREGATE_DIR"] = str(tmp_path / "aggregates")
+    assert _setup_and_check(config)["REPORT_DAYS"] == 7
+
+
+def test_url_normalization_and_cap(tmp_path) -> None:
+    """test_url_normalization_and_cap"""
+    sample = [
+        ("/api/v2/banner/25019354", "0.390"),
+        ("/api/v2/banner/25019355?x=1", "0.100"),
+        ("/api/v2/slot/4705/groups", "0.200"),
+        ("/export/3fa85f64-5717-4562-b3fc-2c963f66afa6/", "0.300"),
+        ("/accounts/login/", "0.400"),
+        ("/api/v2/internal/html5/phantomjs/queue/?wait=1m", "0.500"),
+    ]
+    _write_log(tmp_path / "nginx-access-ui.log-20170630.gz", sample)
+    config = {
+        **_config,
+        "LOG_DIR": str(tmp_path),
+        "URL_STRIP_QUERY": True,
+        "URL_COLLAPSE_IDS": True,
+        "URL_RULES": [[r"^/accounts/.*", "/accounts/*"]],
+    }
+    raw_data = _get_prepared_data(_find_newest_log(config), config)
+    assert {url: stat.count for url, stat in raw_data.urls_stat.items()} == {
+        b"/api/v2/banner/{id}": 2,
+        b"/api/v2/slot/{id}/groups": 1,
+        b"/export/{uuid}/": 1,
+        b"/accounts/*": 1,
+        b"/api/v2/internal/html5/phantomjs/queue/": 1,
+    }
+    raw_data = _get_prepared_data(_find_newest_log(config), {**config, "MAX_URLS": 2})
+    assert {url: stat.count for url, stat in raw_data.urls_stat.items()} == {
+        b"/api/v2/banner/{id}": 2,
+        b"/api/v2/slot/{id}/groups": 1,
+        OTHER_URL: 3,
+    }
+
+
+def test_read_log_byte_lines(tmp_path) -> None:
+    """test_read_log_byte_lines"""
+    lines = [LOG_LINE.format(url=url, request_time=t).encode() for url, t in SAMPLE]
+    with open(tmp_path / "log.gz", "wb") as f:
+        f.write(gzip.compress(b"".join(lines[:3])))
+        f.write(gzip.compress(b"".join(lines[3:])))
+    with open(tmp_path / "log", "wb") as f:
+        f.write(b"".join(lines).rstrip(b"\n"))
+    expected = [line.rstrip(b"\n") for line in lines]
+    assert list(_read_log(str(tmp_path / "log"))) == expected
+    assert list(_read_log(str(tmp_path / "log.gz"), "python")) == expected
+    assert list(_read_log(str(tmp_path / "log.gz"), "zcat")) == expected
+
+
+def test_mmap_parser_matches_line_reader(tmp_path) -> None:
+    """test_mmap_parser_matches_line_reader"""
+    path = tmp_path / "nginx-access-ui.log-20170630"
+    _write_log(path, SAMPLE * 10, broken=2)
+    with open(path, "a") as f:
+        f.write("\n" + LOG_LINE.format(url="/last", request_time="0.5").rstrip("\n"))
+    config = {**_config, "LOG_DIR": str(tmp_path)}
+    log = _find_newest_log(config)
+    by_mmap = _get_prepared_data(log, config)
+    by_lines = _get_prepared_data(log, {**config, "USE_MMAP": False})
+    assert by_mmap.total_urls_count == by_lines.total_urls_count == 81
+    assert by_mmap.errors == by_lines.errors == 3
+    for url, stat in by_lines.urls_stat.items():
+        assert by_mmap.urls_stat[url].quantiles.hist == stat.quantiles.hist
+    size = os.path.getsize(path)
+    chunks = _split_log(str(path), 4)
+    assert chunks[0][0] == 0 and chunks[-1][1] == size
+    with open(path, "rb") as f:
+        data = f.read()
+    for start, end in chunks[1:]:
+        assert data[start - 1 : start] == b"\n"
+
+
+def test_streaming_report_writer(tmp_path) -> None:
+    """test_streaming_report_writer"""
+    shutil.copy(TEMPLATE, tmp_path)
+    report = [
+        {"url": "/api/v2/banner/1", "count": 4, "time_sum": 1.426},
+        {"url": "/api/1/photogenic_banners/", "count": 1, "time_sum": 0.146},
+        {"url": "/search/?q=баннер", "count": 1, "time_sum": 0.1},
+    ]
+    config = {
+        **_config,
+        "REPORT_DIR": str(tmp_path),
+        "REPORT_GZIP": True,
+        "REPORT_SIDE_FILES": ["json", "csv"],
+    }
+    log = Log(date(2017, 6, 30), "nginx-access-ui.log-20170630", "", "")
+    _write_report(report, log, config)
+    with open(TEMPLATE) as f:
+        expected = string.Template(f.read()).safe_substitute(
+            table_json=json.dumps(report)
+        )
+    with open(tmp_path / "report-2017-06-30.html") as f:
+        assert f.read() == expected
+    with gzip.open(tmp_path / "report-2017-06-30.html.gz", "rt") as f:
+        assert f.read() == expected
+    with open(tmp_path / "report-2017-06-30.json") as f:
+        assert json.load(f) == report
+    with open(tmp_path / "report-2017-06-30.csv", encoding="utf-8") as f:
+        assert f.read().splitlines() == [
+            "url,count,time_sum",
+            "/api/v2/banner/1,4,1.426",
+            "/api/1/photogenic_banners/,1,0.146",
+            "/search/?q=баннер,1,0.1",
+        ]
+
+
+def test_log_index_is_reused_until_directory_changes(tmp_path, monkeypatch) -> None:
+    """test_log_index_is_reused_until_directory_changes"""
+    log_dir = tmp_path / "log"
+    log_dir.mkdir()
+    _write_log(log_dir / "nginx-access-ui.log-20170629.gz")
+    (log_dir / "nginx-access-ui.log-20171399").touch()
+    (log_dir / "nginx-access-ui.log-20170630.bz2").touch()
+    config = {
+        **_config,
+        "LOG_DIR": str(log_dir),
+        "INDEX_FILE": str(tmp_path / "index.json"),
+    }
+    assert list(_find_logs(config)) == [date(2017, 6, 29)]
+    scans = []
+    monkeypatch.setattr(
+        log_analyzer, "_scan_logs", lambda path: scans.append(path) or {}
+    )
+    assert _find_newest_log(config).filename == "nginx-access-ui.log-20170629.gz"
+    assert scans == []
+    (log_dir / "nginx-access-ui.log-20170630").touch()
+    os.utime(log_dir, ns=(0, os.stat(log_dir).st_mtime_ns + 1))
+    assert _find_logs(config) == {}
+    assert scans == [str(log_dir)]
+
+
+def test_backfill_builds_missing_reports(tmp_path) -> None:
+    """test_backfill_builds_missing_reports"""
+    log_dir, report_dir = tmp_path / "log", tmp_path / "reports"
+    log_dir.mkdir()
+    report_dir.mkdir()
+    shutil.copy(TEMPLATE, report_dir)
+    for day in ("20170628", "20170629", "20170630"):
+        _write_log(log_dir / f"nginx-access-ui.log-{day}.gz")
+    (report_dir / "report-2017-06-29.html").write_text("built before")
+    config = {
+        **_config,
+        "LOG_DIR": str(log_dir),
+        "REPORT_DIR": str(report_dir),
+        "BACKFILL": True,
+        "WORKERS": 2,
+        "WORKER_MEMORY_MB": 4096,
+    }
+    create_report(config)
+    assert sorted(os.listdir(report_dir)) == [
+        "report-2017-06-28.html",
+        "report-2017-06-29.html",
+        "report-2017-06-30.html",
+        "report-template.html",
+    ]
+    assert (report_dir / "report-2017-06-29.html").read_text() == "built before"
+
+
+def test_columnar_export(tmp_path) -> None:
+    """test_columnar_export"""
+    np = pytest.importorskip("numpy")
+    _write_log(tmp_path / "nginx-access-ui.log-20170630", SAMPLE * 3, broken=1)
+    config = {
+        **_config,
+        "LOG_DIR": str(tmp_path),
+        "REPORT_DIR": str(tmp_path),
+        "COLUMNAR_EXPORT": "npy",
+    }
+    for workers in (1, 2, 4):
+        _get_prepared_data(_find_newest_log(config), {**config, "WORKERS": workers})
+        table, urls = load_columns(str(tmp_path / "requests-2017-06-30.npy"))
+        assert table.dtype.names == ("url_id", "request_time", "status")
+        assert len(table) == len(SAMPLE) * 3
+        assert set(table["status"]) == {200}
+        rows = [
+            (urls[url_id], round(float(t), 3))
+            for url_id, t in table[["url_id", "request_time"]]
+        ]
+        # requests keep the log order whatever the number of workers
+        assert rows == [(url, float(t)) for url, t in SAMPLE * 3]
+        assert np.isclose(
+            table["request_time"].sum(), sum(float(t) for _, t in SAMPLE) * 3
+        )
+
+    for workers in (1, 4):
+        capped = {**config, "MAX_URLS": 2, "WORKERS": workers}
+        raw_data = _get_prepared_data(_find_newest_log(capped), capped)
+        _, urls = load_columns(str(tmp_path / "requests-2017-06-30.npy"))
+        # the export knows only the urls the report has, the rest is (other)
+        assert sorted(urls) == sorted(
+            row["url"] for row in _report_rows(raw_data, capped)
+        )
+        assert len(urls) == 3
+
+
+def test_numpy_engine_matches_aggregate(tmp_path) -> None:
+    """test_numpy_engine_matches_aggregate"""
+    pytest.importorskip("numpy")
+    sample = [
+        (f"/api/v2/banner/{i % 37}", f"{(i * 7919) % 2003 / 1000:.3f}")
+        for i in range(3000)
+    ]
+    _write_log(tmp_path / "nginx-access-ui.log-20170630", sample, broken=4)
+    config = {**_config, "LOG_DIR": str(tmp_path), "REPORT_DIR": str(tmp_path)}
+    log = _find_newest_log(config)
+    expected = _report_rows(_get_prepared_data(log, config), config)
+    for workers in (1, 2, 4):
+        numpy_config = {**config, "STATS_ENGINE": "numpy", "WORKERS": workers}
+        raw_data = _get_prepared_data(log, numpy_config)
+        assert raw_data.errors == 4
+        # parts are merged in log order, so even ties keep their order
+        assert _report_rows(raw_data, numpy_config) == expected
+    for workers in (1, 4):
+        capped = {**config, "MAX_URLS": 10, "WORKERS": workers}
+        expected = _report_rows(_get_prepared_data(log, capped), capped)
+        assert len(expected) == 11
+        numpy_config = {**capped, "STATS_ENGINE": "numpy"}
+        rows = _report_rows(_get_prepared_data(log, numpy_config), numpy_config)
+        assert rows == expected
@@ -1,10 +1,18 @@
+import asyncio
 import collections
 import glob
 import gzip
+import io
+import json
 import logging
 import multiprocessing
 import os
+import queue
+import random
 import sys
+import threading
+import time
+import warnings
 from collections import Counter
 from functools import partial
 from optparse import OptionParser
@@ -13,14 +21,76 @@ from pathlib import Path
 import appsinstalled_pb2
 import memcache
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    # the C extension from 17_c_ext, serializes without protobuf objects
+    import pb
+
+    if not hasattr(pb, "pack_many"):
+        pb = None
+except ImportError:
+    pb = None
+
 NORMAL_ERR_RATE = 0.01
 RETRY_NUMBER = 3
 RETRY_TIMEOUT_SECONDS = 1
+RETRY_MAX_SECONDS = 30
+BREAKER_FAILURES = 5
+BREAKER_RESET_SECONDS = 30
 SOCKET_TIMEOUT_SECONDS = 3
+BATCH_SIZE = 500
+LINGER_SECONDS = 0.5
+WRITER_THREADS = 1
+QUEUE_SIZE = 8
+IN_FLIGHT = 4
+READ_CHUNK_BYTES = 1 << 20
+ENGINES = ("threads", "asyncio")
+CHUNK_BYTES = 8 << 20
+APP_ID_MAX = 2**32 - 1  # apps are uint32 in appsinstalled.proto
+METRICS_INTERVAL_SECONDS = 10
+CHECKPOINT_BYTES = 64 << 20
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 5000)
+LATENCY_QUANTILES = (0.5, 0.9, 0.99)
 
 AppsInstalled = collections.namedtuple(
     "AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"]
 )
+LoaderSettings = collections.namedtuple(
+    "LoaderSettings",
+    [
+        "engine",
+        "batch_size",
+        "linger",
+        "writers",
+        "queue_size",
+        "in_flight",
+        "dead_letter_dir",
+        "chunk_size",
+        "metrics_interval",
+        "metrics_dir",
+        "checkpoint_dir",
+        "checkpoint_bytes",
+    ],
+)
+LoadResult = collections.namedtuple("LoadResult", ["statuses", "records", "errors"])
+DEFAULT_SETTINGS = LoaderSettings(
+    "threads",
+    BATCH_SIZE,
+    LINGER_SECONDS,
+    WRITER_THREADS,
+    QUEUE_SIZE,
+    IN_FLIGHT,
+    None,
+    CHUNK_BYTES,
+    METRICS_INTERVAL_SECONDS,
+    None,
+    None,
+    CHECKPOINT_BYTES,
+)
 
 
 def dot_rename(path):
@@ -29,29 +99,739 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def insert_appsinstalled(memc_client, appsinstalled, dry=False):
-    ua = appsinstalled_pb2.UserApps()
-    ua.lat = appsinstalled.lat
-    ua.lon = appsinstalled.lon
-    key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
-    ua.apps.extend(appsinstalled.apps)
-    packed = ua.SerializeToString()
+def serialize_many(records):
+    """UserApps bytes of (lat, lon, apps) records"""
+    if pb is not None:
+        return pb.pack_many(records)
+    packed = []
+    for lat, lon, apps in records:
+        ua = appsinstalled_pb2.UserApps()
+        ua.lat = lat
+        ua.lon = lon
+        ua.apps.extend(apps)
+        packed.append(ua.SerializeToString())
+    return packed
+
+
+def valid_key(key):
+    """Whether memcached takes the key: up to 250 bytes, no spaces or controls"""
+    encoded = key.encode("utf-8")
+    return (
+        len(encoded) <= memcache.SERVER_MAX_KEY_LENGTH
+        and memcache.valid_key_chars_re.match(encoded) is not None
+    )
+
+
+def backoff_delay(attempt):
+    # full jitter: spreads the retries of all writers hitting the same server
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_TIMEOUT_SECONDS * 2**attempt))
+
+
+class CircuitBreaker:
+    """Stops writes to a server after `failures` failed attempts in a row.
+
+    While open, batches fail at once instead of waiting for socket timeouts.
+    Every reset_timeout seconds one trial write is let through, its success
+    closes the breaker again.
+    """
+
+    def __init__(
+        self, address, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_SECONDS
+    ):
+        self.address = address
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.failed = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logging.info(f"Circuit for {self.address} closed")
+            self.failed = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failed += 1
+            if self.failed >= self.failures:
+                if self.opened_at is None:
+                    logging.error(f"Circuit for {self.address} opened")
+                self.opened_at = time.monotonic()
+
+
+class DeadLetter:
+    """Appends records that could not be written to a gzipped tsv file.
+
+    The file has the memc_load input format, so it can be replayed later with
+    --pattern pointing at it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.lock = threading.Lock()
 
-    for _ in range(RETRY_NUMBER):
+    def write(self, batch):
+        lines = []
+        for key, packed in batch.items():
+            dev_type, dev_id = key.split(":", 1)
+            ua = appsinstalled_pb2.UserApps()
+            ua.ParseFromString(packed)
+            apps = ",".join(map(str, ua.apps))
+            lines.append(f"{dev_type}\t{dev_id}\t{ua.lat!r}\t{ua.lon!r}\t{apps}\n")
+        with self.lock:
+            if self.fd is None:
+                self.fd = gzip.open(self.path, "at")
+            self.fd.writelines(lines)
+
+    def flush(self):
+        with self.lock:
+            if self.fd is not None:
+                self.fd.flush()
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            logging.warning(f"Failed records saved to {self.path}")
+
+
+def save_failed(dead_letter, batch):
+    if dead_letter is None:
+        return
+    try:
+        dead_letter.write(batch)
+    except Exception as exc:
+        logging.exception(
+            "Cannot save %d failed records to %s: %s"
+            % (len(batch), dead_letter.path, exc)
+        )
+
+
+def make_dead_letter(fn, dead_letter_dir):
+    if not dead_letter_dir:
+        return None
+    os.makedirs(dead_letter_dir, exist_ok=True)
+    # chunks of one file may be loaded by several processes at once
+    name = "%s-%d-%s" % (
+        time.strftime("%Y%m%d%H%M%S"),
+        os.getpid(),
+        os.path.basename(fn),
+    )
+    return DeadLetter(os.path.join(dead_letter_dir, name))
+
+
+class Checkpoint:
+    """Progress of one input file, kept in a json file next to the others.
+
+    offset is the position in the uncompressed stream up to which every record
+    was either stored or written to the dead letter file, lines is the number
+    of lines before it, result the LoadResult of those lines. A checkpoint of
+    another version of the file, by size or mtime, is ignored. Sets are
+    idempotent, so lines after the offset are simply loaded again.
+    """
+
+    def __init__(self, path, fn):
+        self.path = path
+        stat = os.stat(fn)
+        self.source = [stat.st_size, stat.st_mtime_ns]
+        self.offset = self.lines = 0
+        self.result = LoadResult(Counter(), Counter(), Counter())
         try:
-            if dry:
-                logging.debug(
-                    "%s - %s -> %s"
-                    % (memc_client.servers, key, str(ua).replace("\n", " "))
-                )
-            else:
-                memc_client.set_multi({key: packed})
-            return True
+            with open(path, "r") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as exc:
+            logging.error(f"Ignoring broken checkpoint {path}: {exc}")
+            return
+        if saved["source"] != self.source:
+            logging.warning(f"Ignoring checkpoint {path} of another version of {fn}")
+            return
+        self.offset, self.lines = saved["offset"], saved["lines"]
+        self.result = LoadResult(*(Counter(part) for part in saved["result"]))
+
+    def merge(self, result):
+        """Result of the whole file from the result of the lines after offset"""
+        return merge_results([self.result, result])
+
+    def save(self, offset, lines, result):
+        state = {
+            "source": self.source,
+            "offset": offset,
+            "lines": lines,
+            "result": self.merge(result),
+        }
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def checkpoint_path(fn, checkpoint_dir):
+    return os.path.join(checkpoint_dir, os.path.basename(fn) + ".checkpoint")
+
+
+def remove_checkpoint(fn, checkpoint_dir):
+    try:
+        os.remove(checkpoint_path(fn, checkpoint_dir))
+    except FileNotFoundError:
+        pass
+
+
+def make_checkpoint(fn, checkpoint_dir, dry=False):
+    # a dry run writes nothing, so it must not mark lines as loaded
+    if not checkpoint_dir or dry:
+        return None
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    return Checkpoint(checkpoint_path(fn, checkpoint_dir), fn)
+
+
+def resume(fd, fn, checkpoint):
+    """Skip the lines of fd loaded before, return (offset, lines) to go on from"""
+    if checkpoint is None or not checkpoint.offset:
+        return 0, 0
+    worker = multiprocessing.current_process()
+    logging.info(
+        f"[{worker.name}] [{fn}] Resuming after line {checkpoint.lines}, "
+        f"{checkpoint.offset} bytes"
+    )
+    # gzip has to decompress up to the offset, but that is much faster than
+    # parsing and writing the lines again
+    fd.seek(checkpoint.offset)
+    return checkpoint.offset, checkpoint.lines
+
+
+class Metrics:
+    """Throughput, batch and write latency counters of one worker process.
+
+    Parser, writer threads and async tasks update it, report() logs the rates
+    since the previous report and, with a directory, rewrites a Prometheus
+    text file memc_load_<worker name>.prom for the node_exporter textfile
+    collector.
+    Latency quantiles cover the last interval, the other counters are totals.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = self.bytes = self.batched = 0
+        self.batch_sizes = Counter()
+        self.writes = Counter()
+        self.retries = Counter()
+        self.latencies = collections.defaultdict(list)
+        self.queues = {}
+        self.directory = None
+        self.thread = None
+        self.reported = (time.monotonic(), 0, 0)
+
+    def parsed(self, size, lines):
+        with self.lock:
+            self.bytes += size
+            self.lines += lines
+
+    def written(self, server, batch_size, seconds):
+        bucket = next((b for b in BATCH_SIZE_BUCKETS if batch_size <= b), "+Inf")
+        with self.lock:
+            self.batch_sizes[bucket] += 1
+            self.batched += batch_size
+            self.writes[server] += 1
+            self.latencies[server].append(seconds)
+
+    def retried(self, server):
+        with self.lock:
+            self.retries[server] += 1
+
+    def watch_queue(self, name, depth):
+        """Sample depth() on every report until unwatch_queue(name)"""
+        with self.lock:
+            self.queues[name] = depth
+
+    def unwatch_queue(self, name):
+        with self.lock:
+            self.queues.pop(name, None)
+
+    def start(self, interval, directory=None):
+        """Report every interval seconds from a daemon thread, once per process"""
+        self.directory = directory
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as exc:
+                logging.error("Cannot create metrics dir %s: %s" % (directory, exc))
+        if self.thread is not None or not interval:
+            return
+        self.thread = threading.Thread(
+            target=self.run, args=(interval,), name="metrics", daemon=True
+        )
+        self.thread.start()
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            self.safe_report()
+
+    def safe_report(self):
+        """Report, a broken metrics sink must not fail the load"""
+        try:
+            self.report()
+        except Exception as exc:
+            logging.exception("Cannot report metrics: %s" % exc)
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            latencies, self.latencies = self.latencies, collections.defaultdict(list)
+            queues = {name: depth() for name, depth in self.queues.items()}
+            lines, size = self.lines, self.bytes
+            batch_sizes = Counter(self.batch_sizes)
+            batched = self.batched
+            retries = Counter(self.retries)
+            writes = Counter(self.writes)
+            reported_at, reported_lines, reported_bytes = self.reported
+            self.reported = (now, lines, size)
+        elapsed = max(now - reported_at, 1e-9)
+        quantiles = {}
+        for server, values in latencies.items():
+            values.sort()
+            quantiles[server] = [
+                values[int(q * (len(values) - 1))] for q in LATENCY_QUANTILES
+            ]
+
+        worker = multiprocessing.current_process()
+        histogram = " ".join(
+            f"<={bucket}:{batch_sizes[bucket]}"
+            for bucket in BATCH_SIZE_BUCKETS + ("+Inf",)
+            if batch_sizes[bucket]
+        )
+        logging.info(
+            f"[{worker.name}] metrics: "
+            f"{(lines - reported_lines) / elapsed:.0f} lines/s, "
+            f"{(size - reported_bytes) / elapsed / (1 << 20):.1f} MB/s decompressed, "
+            f"batch sizes {histogram or '-'}"
+        )
+        for server in sorted(set(writes) | set(queues)):
+            latency = "/".join(f"{q * 1000:.1f}" for q in quantiles.get(server, ()))
+            logging.info(
+                f"[{worker.name}] metrics: {server} "
+                f"latency p50/p90/p99 {latency or '-'} ms, "
+                f"queue {queues.get(server, 0)}, retries {retries[server]}"
+            )
+        if self.directory:
+            self.write_prometheus(
+                lines, size, batch_sizes, batched, writes, retries, quantiles, queues
+            )
+
+    def write_prometheus(
+        self, lines, size, batch_sizes, batched, writes, retries, quantiles, queues
+    ):
+        # pool workers are named by index, so every run rewrites the same
+        # files instead of leaving a file per process id behind
+        worker = multiprocessing.current_process().name
+        rows = [
+            "# TYPE memc_load_lines_total counter",
+            f'memc_load_lines_total{{worker="{worker}"}} {lines}',
+            "# TYPE memc_load_bytes_total counter",
+            f'memc_load_bytes_total{{worker="{worker}"}} {size}',
+            "# TYPE memc_load_batch_size histogram",
+        ]
+        cumulative = 0
+        for bucket in BATCH_SIZE_BUCKETS + ("+Inf",):
+            cumulative += batch_sizes[bucket]
+            rows.append(
+                f'memc_load_batch_size_bucket{{worker="{worker}",le="{bucket}"}} {cumulative}'
+            )
+        rows.append(f'memc_load_batch_size_sum{{worker="{worker}"}} {batched}')
+        rows.append(f'memc_load_batch_size_count{{worker="{worker}"}} {cumulative}')
+        rows.append("# TYPE memc_load_writes_total counter")
+        rows.extend(
+            f'memc_load_writes_total{{worker="{worker}",server="{server}"}} {count}'
+            for server, count in sorted(writes.items())
+        )
+        rows.append("# TYPE memc_load_retries_total counter")
+        rows.extend(
+            f'memc_load_retries_total{{worker="{worker}",server="{server}"}} {retries[server]}'
+            for server in sorted(writes)
+        )
+        rows.append("# TYPE memc_load_write_latency_seconds summary")
+        for server, values in sorted(quantiles.items()):
+            rows.extend(
+                f'memc_load_write_latency_seconds{{worker="{worker}",server="{server}",'
+                f'quantile="{q}"}} {value:.6f}'
+                for q, value in zip(LATENCY_QUANTILES, values)
+            )
+        rows.append("# TYPE memc_load_queue_depth gauge")
+        rows.extend(
+            f'memc_load_queue_depth{{worker="{worker}",server="{server}"}} {depth}'
+            for server, depth in sorted(queues.items())
+        )
+        path = os.path.join(self.directory, f"memc_load_{worker}.prom")
+        # the collector must never read a half written file
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(rows) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+metrics = Metrics()
+
+
+def insert_appsinstalled(memc_client, batch, dry=False, breaker=None, address=None):
+    """Write {key: packed} with set_multi, return records still failing after retries.
+
+    address is the configured server name used in metrics and logs.
+    """
+    if dry:
+        for key, packed in batch.items():
+            logging.debug("%s - %s -> %r" % (memc_client.servers, key, packed))
+        return {}
+    server = address or str(memc_client.servers[0])
+    for attempt in range(RETRY_NUMBER):
+        if breaker is not None and not breaker.allow():
+            break
+        started = time.monotonic()
+        try:
+            failed = memc_client.set_multi(batch)
+            if memc_client.servers[0].socket is None:
+                # the connection broke while reading replies: set_multi lists
+                # only the keys answered with an error, not the unanswered ones
+                failed = list(batch)
+        except memcache.Client.MemcachedKeyError as exc:
+            # the same keys fail again on every retry and say nothing about
+            # the server, so neither retry nor count it against the breaker
+            logging.error("Invalid keys in batch to memc %s: %s" % (server, exc))
+            return batch
         except Exception as exc:
             logging.exception(
                 "Cannot write to memc %s: %s" % (memc_client.servers, exc)
             )
+            failed = list(batch)
+        metrics.written(server, len(batch), time.monotonic() - started)
+        if not failed:
+            if breaker is not None:
+                breaker.success()
+            return {}
+        batch = {key: batch[key] for key in failed}
+        if breaker is not None:
+            breaker.failure()
+        if attempt + 1 < RETRY_NUMBER:
+            metrics.retried(server)
+            time.sleep(backoff_delay(attempt))
+    logging.error("Cannot write %d records to memc %s" % (len(batch), server))
+    return batch
+
+
+def make_memc_client(address):
+    # a client marked dead skips the server, so the retry after the backoff
+    # would fail without trying, down servers are the breaker's business
+    return memcache.Client(
+        [address], socket_timeout=SOCKET_TIMEOUT_SECONDS, dead_retry=0
+    )
+
+
+class ShardWriter:
+    """Writer threads draining batches of one device type from a bounded queue.
+
+    put() blocks while the queue is full, so a slow memcached slows the parser
+    down instead of piling batches up in memory. With threads=0 batches are
+    written by the caller.
+    """
+
+    def __init__(
+        self,
+        address,
+        threads=WRITER_THREADS,
+        queue_size=QUEUE_SIZE,
+        dry=False,
+        dead_letter=None,
+    ):
+        self.address = address
+        self.dry = dry
+        self.dead_letter = dead_letter
+        self.breaker = CircuitBreaker(address)
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.memc_client = None if threads else make_memc_client(address)
+        # clients are made here, so a bad address fails the load at once
+        self.threads = [
+            threading.Thread(
+                target=self.run,
+                args=(make_memc_client(address),),
+                name=f"writer-{address}",
+                daemon=True,
+            )
+            for _ in range(threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+        metrics.watch_queue(address, self.queue.qsize)
+
+    def run(self, memc_client):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            try:
+                self.write(memc_client, batch)
+            finally:
+                self.queue.task_done()
+
+    def write(self, memc_client, batch):
+        # a writer thread must survive any batch, or put() and drain() hang
+        try:
+            failed = insert_appsinstalled(
+                memc_client, batch, self.dry, self.breaker, self.address
+            )
+        except Exception as exc:
+            logging.exception("Cannot write to memc %s: %s" % (self.address, exc))
+            failed = batch
+        if failed:
+            with self.lock:
+                self.errors += len(failed)
+            save_failed(self.dead_letter, failed)
+
+    def put(self, batch):
+        if self.threads:
+            self.queue.put(batch)
+        else:
+            self.write(self.memc_client, batch)
+
+    def drain(self):
+        """Wait until every batch put so far is written"""
+        if self.threads:
+            self.queue.join()
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        metrics.unwatch_queue(self.address)
+
+
+class AsyncShardWriter:
+    """Pipelines memcached text protocol sets over one persistent connection.
+
+    Every batch is sent as a single write of `set` commands, replies are read
+    in order by a background task, and at most in_flight batches per server
+    wait for their replies at any time.
+    """
+
+    def __init__(self, address, in_flight=IN_FLIGHT, dry=False, dead_letter=None):
+        self.address = address
+        self.in_flight = in_flight
+        self.dry = dry
+        self.dead_letter = dead_letter
+        self.breaker = CircuitBreaker(address)
+        self.errors = 0
+        self.slots = asyncio.Semaphore(in_flight)
+        self.connecting = asyncio.Lock()
+        self.tasks = set()
+        self.writer = self.reply_task = self.pending = None
+        metrics.watch_queue(address, self.tasks.__len__)
+
+    async def connect(self):
+        host, port = self.address.rsplit(":", 1)
+        reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(host, int(port)), SOCKET_TIMEOUT_SECONDS
+        )
+        self.pending = asyncio.Queue()
+        self.reply_task = asyncio.create_task(self.read_replies(reader, self.pending))
+
+    async def read_replies(self, reader, pending):
+        while True:
+            future, keys = await pending.get()
+            failed = []
+            try:
+                for key in keys:
+                    reply = await reader.readline()
+                    if not reply:
+                        raise ConnectionError("connection closed by server")
+                    if reply.startswith((b"ERROR", b"CLIENT_ERROR")):
+                        # the server took part of a command for another one,
+                        # the next replies would be matched to wrong keys
+                        raise ConnectionError(f"protocol error: {reply!r}")
+                    if reply != b"STORED\r\n":
+                        failed.append(key)
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+                return
+            if not future.done():
+                future.set_result(failed)
+
+    def disconnect(self, writer=None):
+        if writer is not None and writer is not self.writer:
+            return
+        if self.reply_task is not None:
+            self.reply_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        while self.pending is not None and not self.pending.empty():
+            future, _ = self.pending.get_nowait()
+            if not future.done():
+                future.set_exception(ConnectionError("connection reset"))
+        self.writer = self.reply_task = self.pending = None
+
+    async def set_many(self, batch):
+        if self.dry:
+            for key, packed in batch.items():
+                logging.debug("%s - %s -> %r" % (self.address, key, packed))
+            return
+        invalid = {key: packed for key, packed in batch.items() if not valid_key(key)}
+        if invalid:
+            logging.error("Invalid keys to memc %s: %r" % (self.address, list(invalid)))
+            self.errors += len(invalid)
+            save_failed(self.dead_letter, invalid)
+            batch = {key: packed for key, packed in batch.items() if key not in invalid}
+            if not batch:
+                return
+        for attempt in range(RETRY_NUMBER):
+            if not self.breaker.allow():
+                break
+            failed = await self.send(batch)
+            if not failed:
+                self.breaker.success()
+                return
+            batch = {key: batch[key] for key in failed}
+            self.breaker.failure()
+            if attempt + 1 < RETRY_NUMBER:
+                metrics.retried(self.address)
+                await asyncio.sleep(backoff_delay(attempt))
+        logging.error("Cannot write %d records to memc %s" % (len(batch), self.address))
+        self.errors += len(batch)
+        save_failed(self.dead_letter, batch)
+
+    async def send(self, batch):
+        """Send one pipelined batch, return the keys that were not stored"""
+        writer = None
+        async with self.slots:
+            started = time.monotonic()
+            try:
+                async with self.connecting:
+                    if self.writer is None:
+                        await self.connect()
+                writer = self.writer
+                future = asyncio.get_running_loop().create_future()
+                writer.write(
+                    b"".join(
+                        b"set %s 0 0 %d\r\n%s\r\n" % (key.encode(), len(packed), packed)
+                        for key, packed in batch.items()
+                    )
+                )
+                self.pending.put_nowait((future, list(batch)))
+                await writer.drain()
+                failed = await asyncio.wait_for(future, SOCKET_TIMEOUT_SECONDS)
+            except Exception as exc:
+                logging.exception("Cannot write to memc %s: %s" % (self.address, exc))
+                # replies of the other batches can no longer be matched
+                self.disconnect(writer)
+                failed = list(batch)
+            metrics.written(self.address, len(batch), time.monotonic() - started)
+            return failed
+
+    def put(self, batch):
+        task = asyncio.create_task(self.set_many(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def ready(self):
+        while len(self.tasks) > self.in_flight:
+            await asyncio.wait(self.tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    async def drain(self):
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+    async def close(self):
+        await self.drain()
+        self.disconnect()
+        metrics.unwatch_queue(self.address)
+
+
+class ShardBuffer:
+    """Collects records of one device type until batch_size or linger is reached.
+
+    The linger of a partial batch is checked by expire() after every parsed
+    block, so a rarely used device type does not hold its records until EOF.
+    """
+
+    def __init__(self, writer, batch_size=BATCH_SIZE, linger=LINGER_SECONDS):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.linger = linger
+        self.batch = {}
+        self.started = 0.0
+
+    def add(self, key, record):
+        if not self.batch:
+            self.started = time.monotonic()
+        self.batch[key] = record
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def expire(self, now):
+        if self.batch and now - self.started >= self.linger:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            packed = serialize_many(self.batch.values())
+            self.writer.put(dict(zip(self.batch, packed)))
+            self.batch = {}
+
+
+class ShardRouter:
+    """Sends each record to the buffer and writer of its device type.
+
+    Every device type has its own memcached address, so there is one writer,
+    with its own clients or connection, per device type.
+    """
+
+    def __init__(self, device_memc, make_writer, batch_size, linger):
+        self.writers = {
+            dev_type: make_writer(address) for dev_type, address in device_memc.items()
+        }
+        self.buffers = {
+            dev_type: ShardBuffer(writer, batch_size, linger)
+            for dev_type, writer in self.writers.items()
+        }
+        self.records = Counter()
+
+    def route(self, appsinstalled):
+        buffer = self.buffers.get(appsinstalled.dev_type)
+        if buffer is None:
+            logging.error(f"Unknown device type: {appsinstalled.dev_type}")
             return False
+        key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
+        if not valid_key(key):
+            logging.error(f"Invalid memcached key: {key!r}")
+            return False
+        buffer.add(key, (appsinstalled.lat, appsinstalled.lon, appsinstalled.apps))
+        self.records[appsinstalled.dev_type] += 1
+        return True
+
+    def expire(self):
+        now = time.monotonic()
+        for buffer in self.buffers.values():
+            buffer.expire(now)
+
+    def flush(self):
+        for buffer in self.buffers.values():
+            buffer.flush()
+
+    def errors(self):
+        return Counter(
+            {dev_type: writer.errors for dev_type, writer in self.writers.items()}
+        )
 
 
 def parse_appsinstalled(line):
@@ -64,7 +844,7 @@ def parse_appsinstalled(line):
     try:
         apps = [int(a.strip()) for a in raw_apps.split(",")]
     except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
+        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isdigit()]
         logging.info("Not all user apps are digits: `%s`" % line)
     try:
         lat, lon = float(lat), float(lon)
@@ -73,38 +853,235 @@ def parse_appsinstalled(line):
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
-def process_line(raw_line, memc_client, dry):
-    line = raw_line.decode("utf-8").strip()
-    if not line:
-        return "NO LINE"
+def parse_apps(raw_apps):
+    """Convert the app lists of many lines at once, None if any app is invalid"""
+    joined = ",".join(raw_apps)
+    total = joined.count(",") + 1
     try:
-        appsinstalled = parse_appsinstalled(line)
-    except ValueError as e:
-        logging.error(f"Cannot parse line: {e}")
-        return "ERR"
+        if np is not None:
+            with warnings.catch_warnings():
+                # before NumPy 2.3 fromstring warns and stops at the first
+                # invalid number, later versions raise ValueError
+                warnings.simplefilter("ignore", DeprecationWarning)
+                apps = np.fromstring(joined, dtype=np.int64, sep=",")
+            # numbers beyond int64 are clamped to its limits, so out of range
+            if len(apps) != total or apps.min() < 0 or apps.max() > APP_ID_MAX:
+                return None
+            return apps.tolist()
+        apps = list(map(int, joined.split(",")))
+    except ValueError:
+        return None
+    return apps if min(apps) >= 0 and max(apps) <= APP_ID_MAX else None
 
-    result = insert_appsinstalled(memc_client, appsinstalled, dry)
-    if not result:
-        return "ERR"
 
-    return "OK"
+def parse_rows(rows):
+    """Records of split lines, None if any number of any line is invalid"""
+    try:
+        coords = [(float(parts[2]), float(parts[3])) for parts in rows]
+    except ValueError:
+        return None
+    apps = parse_apps([parts[4] for parts in rows])
+    if apps is None:
+        return None
+    records = []
+    position = 0
+    for (dev_type, dev_id, _, _, raw_apps), (lat, lon) in zip(rows, coords):
+        count = raw_apps.count(",") + 1
+        records.append(
+            AppsInstalled(dev_type, dev_id, lat, lon, apps[position : position + count])
+        )
+        position += count
+    return records
 
 
-def process_file(fn, device_memc, dry) -> None:
-    worker = multiprocessing.current_process()
-    logging.info(f"[{worker.name}] Processing {fn}")
+def valid_record(appsinstalled):
+    """Whether UserApps can hold the record parse_appsinstalled returned"""
+    if not isinstance(appsinstalled.lat, float) or not isinstance(
+        appsinstalled.lon, float
+    ):
+        return False
+    if not all(0 <= app <= APP_ID_MAX for app in appsinstalled.apps):
+        logging.info(f"App ids out of range: {appsinstalled.dev_id}")
+        return False
+    return True
 
-    memc_client = memcache.Client(
+
+def parse_block(block):
+    """Parse a block of whole lines, converting the numbers of all lines at once.
+
+    Returns the parsed records and the number of unparsable lines. When the
+    conversion of some lines fails, they are halved until the lines that do not
+    fit are found, and those go through parse_appsinstalled one by one.
+    """
+    records = []
+    errors = 0
+    rows = []
+    slow_lines = []
+    for line in block.decode("utf-8").split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        parts = line.split("\t")
+        if len(parts) == 5 and parts[0] and parts[1]:
+            rows.append(parts)
+        else:
+            slow_lines.append(line)
+
+    pending = [rows] if rows else []
+    while pending:
+        part = pending.pop()
+        parsed = parse_rows(part)
+        if parsed is not None:
+            records.extend(parsed)
+        elif len(part) == 1:
+            slow_lines.append("\t".join(part[0]))
+        else:
+            middle = len(part) // 2
+            pending += [part[middle:], part[:middle]]
+
+    for line in slow_lines:
+        try:
+            appsinstalled = parse_appsinstalled(line)
+        except ValueError as e:
+            logging.error(f"Cannot parse line: {e}")
+            appsinstalled = None
+        if appsinstalled is None or not valid_record(appsinstalled):
+            errors += 1
+        else:
+            records.append(appsinstalled)
+    return records, errors
+
+
+def process_block(block, router):
+    metrics.parsed(len(block), block.count(b"\n"))
+    records, errors = parse_block(block)
+    statuses = Counter(ERR=errors)
+    for appsinstalled in records:
+        statuses["OK" if router.route(appsinstalled) else "ERR"] += 1
+    router.expire()
+    return statuses
+
+
+def load_stream(
+    fd, device_memc, dry, settings, dead_letter, checkpoint=None, start=(0, 0)
+):
+    router = ShardRouter(
         device_memc,
-        socket_timeout=3,
-        dead_retry=RETRY_TIMEOUT_SECONDS,
+        lambda address: ShardWriter(
+            address, settings.writers, settings.queue_size, dry, dead_letter
+        ),
+        settings.batch_size,
+        settings.linger,
     )
-    with gzip.open(fn) as fd:
-        job = partial(process_line, memc_client=memc_client, dry=dry)
-        statuses = Counter(map(job, fd))
+    statuses = Counter()
+    offset, lines = start
+    synced = offset
+    try:
+        for block in read_blocks(fd, READ_CHUNK_BYTES):
+            statuses.update(process_block(block, router))
+            offset, lines = offset + len(block), lines + block.count(b"\n")
+            if checkpoint is not None and offset - synced >= settings.checkpoint_bytes:
+                router.flush()
+                for writer in router.writers.values():
+                    writer.drain()
+                sync(checkpoint, dead_letter, offset, lines, statuses, router)
+                synced = offset
+        router.flush()
+    finally:
+        for writer in router.writers.values():
+            writer.close()
+    if checkpoint is not None:
+        sync(checkpoint, dead_letter, offset, lines, statuses, router)
+    return LoadResult(statuses, router.records, router.errors())
+
 
-    ok = statuses["OK"]
-    errors = statuses["ERR"]
+async def load_stream_async(
+    fd, device_memc, dry, settings, dead_letter, checkpoint=None, start=(0, 0)
+):
+    router = ShardRouter(
+        device_memc,
+        lambda address: AsyncShardWriter(address, settings.in_flight, dry, dead_letter),
+        settings.batch_size,
+        settings.linger,
+    )
+    statuses = Counter()
+    offset, lines = start
+    synced = offset
+    try:
+        for block in read_blocks(fd, READ_CHUNK_BYTES):
+            statuses.update(process_block(block, router))
+            offset, lines = offset + len(block), lines + block.count(b"\n")
+            if checkpoint is not None and offset - synced >= settings.checkpoint_bytes:
+                router.flush()
+                await asyncio.gather(*(w.drain() for w in router.writers.values()))
+                sync(checkpoint, dead_letter, offset, lines, statuses, router)
+                synced = offset
+            # let the sends run and wait while any server is saturated
+            await asyncio.gather(*(w.ready() for w in router.writers.values()))
+        router.flush()
+    finally:
+        await asyncio.gather(*(w.close() for w in router.writers.values()))
+    if checkpoint is not None:
+        sync(checkpoint, dead_letter, offset, lines, statuses, router)
+    return LoadResult(statuses, router.records, router.errors())
+
+
+def sync(checkpoint, dead_letter, offset, lines, statuses, router):
+    """Save a checkpoint, every batch routed so far must be written already"""
+    if dead_letter is not None:
+        dead_letter.flush()
+    checkpoint.save(
+        offset, lines, LoadResult(statuses, router.records, router.errors())
+    )
+
+
+def load(fd, fn, device_memc, dry, settings, checkpoint=None):
+    """Load lines of binary stream fd, return a LoadResult.
+
+    With a checkpoint, lines loaded by an earlier run are skipped and the
+    progress is saved every settings.checkpoint_bytes.
+    """
+    dead_letter = make_dead_letter(fn, settings.dead_letter_dir)
+    start = resume(fd, fn, checkpoint)
+    try:
+        if settings.engine == "asyncio":
+            return asyncio.run(
+                load_stream_async(
+                    fd, device_memc, dry, settings, dead_letter, checkpoint, start
+                )
+            )
+        return load_stream(
+            fd, device_memc, dry, settings, dead_letter, checkpoint, start
+        )
+    finally:
+        if dead_letter is not None:
+            dead_letter.close()
+
+
+def merge_results(results):
+    total = LoadResult(Counter(), Counter(), Counter())
+    for result in results:
+        for counter, part in zip(total, result):
+            counter.update(part)
+    return total
+
+
+def check_error_rate(fn, result, elapsed, resumed=None):
+    """Log per-shard totals and the error rate of the whole file.
+
+    resumed is the result saved by an earlier run, it counts in the totals but
+    not in the records/s of this run.
+    """
+    worker = multiprocessing.current_process()
+    for dev_type, records in sorted(result.records.items()):
+        loaded = records - (resumed.records[dev_type] if resumed else 0)
+        logging.info(
+            f"[{worker.name}] [{fn}] {dev_type}: {records} records, "
+            f"{loaded / elapsed:.0f} records/s, {result.errors[dev_type]} errors"
+        )
+    write_errors = sum(result.errors.values())
+    ok = result.statuses["OK"] - write_errors
+    errors = result.statuses["ERR"] + write_errors
     processed = ok + errors
 
     err_rate = float(errors) / processed if processed else 1.0
@@ -120,6 +1097,76 @@ def process_file(fn, device_memc, dry) -> None:
             f"{err_rate} > {NORMAL_ERR_RATE}. Failed load"
         )
 
+
+def process_file(fn, device_memc, dry, settings=DEFAULT_SETTINGS):
+    worker = multiprocessing.current_process()
+    logging.info(f"[{worker.name}] Processing {fn}")
+    metrics.start(settings.metrics_interval, settings.metrics_dir)
+
+    checkpoint = make_checkpoint(fn, settings.checkpoint_dir, dry)
+    started = time.monotonic()
+    with gzip.open(fn) as fd:
+        result = load(fd, fn, device_memc, dry, settings, checkpoint)
+    elapsed = time.monotonic() - started
+    if checkpoint is None:
+        check_error_rate(fn, result, elapsed)
+    else:
+        check_error_rate(fn, checkpoint.merge(result), elapsed, checkpoint.result)
+    metrics.safe_report()
+    return fn
+
+
+def process_chunk(chunk, fn, device_memc, dry, settings=DEFAULT_SETTINGS):
+    metrics.start(settings.metrics_interval, settings.metrics_dir)
+    result = load(io.BytesIO(chunk), fn, device_memc, dry, settings)
+    metrics.safe_report()
+    return result
+
+
+def read_blocks(fd, block_size):
+    """Yield blocks of about block_size bytes ending on a line end"""
+    while True:
+        block = fd.read(block_size)
+        if not block:
+            return
+        if not block.endswith(b"\n"):
+            block += fd.readline()
+        yield block
+
+
+def process_file_chunks(pool, fn, device_memc, dry, settings):
+    """Spread the lines of one file over the pool, keep the error rate per file"""
+    logging.info(f"[MainProcess] Processing {fn} in chunks")
+    job = partial(
+        process_chunk, fn=fn, device_memc=device_memc, dry=dry, settings=settings
+    )
+    checkpoint = make_checkpoint(fn, settings.checkpoint_dir, dry)
+    started = time.monotonic()
+    results = []
+
+    def collect(end, lines, result):
+        # results come in file order, so every chunk before this one is loaded
+        results.append(result.get())
+        if checkpoint is not None:
+            checkpoint.save(end, lines, merge_results(results))
+
+    # only a couple of chunks per worker are held in memory at once
+    pending = collections.deque()
+    with gzip.open(fn) as fd:
+        offset, lines = resume(fd, fn, checkpoint)
+        for chunk in read_blocks(fd, settings.chunk_size):
+            if len(pending) >= 2 * (os.cpu_count() or 1):
+                collect(*pending.popleft())
+            offset, lines = offset + len(chunk), lines + chunk.count(b"\n")
+            pending.append((offset, lines, pool.apply_async(job, (chunk,))))
+    while pending:
+        collect(*pending.popleft())
+    result = merge_results(results)
+    elapsed = time.monotonic() - started
+    if checkpoint is None:
+        check_error_rate(fn, result, elapsed)
+    else:
+        check_error_rate(fn, checkpoint.merge(result), elapsed, checkpoint.result)
     return fn
 
 
@@ -130,15 +1177,43 @@ def main(options):
         "adid": options.adid,
         "dvid": options.dvid,
     }
-    job = partial(process_file, device_memc=device_memc, dry=options.dry)
+    settings = LoaderSettings(
+        engine=options.engine,
+        batch_size=options.batch_size,
+        linger=options.linger,
+        writers=options.writers,
+        queue_size=options.queue_size,
+        in_flight=options.in_flight,
+        dead_letter_dir=options.dead_letter,
+        chunk_size=options.chunk_size,
+        metrics_interval=options.metrics_interval,
+        metrics_dir=options.metrics_dir,
+        checkpoint_dir=options.checkpoint_dir,
+        checkpoint_bytes=options.checkpoint_bytes,
+    )
 
     files = sorted(glob.glob(options.pattern), key=lambda file: Path(file).name)
 
     with multiprocessing.Pool() as pool:
-        for processed_file in pool.imap(job, files):
+        if options.split_files:
+            processed_files = (
+                process_file_chunks(pool, fn, device_memc, options.dry, settings)
+                for fn in files
+            )
+        else:
+            job = partial(
+                process_file,
+                device_memc=device_memc,
+                dry=options.dry,
+                settings=settings,
+            )
+            processed_files = pool.imap(job, files)
+        for processed_file in processed_files:
             worker = multiprocessing.current_process()
             logging.info(f"[{worker.name}] Renaming {processed_file}")
             dot_rename(processed_file)
+            if settings.checkpoint_dir:
+                remove_checkpoint(processed_file, settings.checkpoint_dir)
 
 
 def prototest():
@@ -157,9 +1232,47 @@ def prototest():
         assert ua == unpacked
 
 
+def bench_parser(pattern):
+    """Compare per-line parsing with parse_block, time serialization"""
+    for fn in sorted(glob.glob(pattern)):
+        with gzip.open(fn) as fd:
+            data = fd.read()
+
+        started = time.perf_counter()
+        lines = 0
+        for raw_line in io.BytesIO(data):
+            line = raw_line.decode("utf-8").strip()
+            if line:
+                parse_appsinstalled(line)
+                lines += 1
+        line_rate = lines / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for block in read_blocks(io.BytesIO(data), READ_CHUNK_BYTES):
+            parse_block(block)
+        block_rate = lines / (time.perf_counter() - started)
+
+        records = [
+            (record.lat, record.lon, record.apps)
+            for block in read_blocks(io.BytesIO(data), READ_CHUNK_BYTES)
+            for record in parse_block(block)[0]
+        ]
+        started = time.perf_counter()
+        serialize_many(records)
+        serialize_rate = len(records) / (time.perf_counter() - started)
+
+        print(
+            f"{fn}: {lines} lines, per line {line_rate:,.0f} lines/s, "
+            f"blocks {block_rate:,.0f} lines/s ({block_rate / line_rate:.1f}x), "
+            f"serialize with {'pb' if pb else 'appsinstalled_pb2'} "
+            f"{serialize_rate:,.0f} records/s"
+        )
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-t", "--test", action="store_true", default=False)
+    op.add_option("--bench-parser", action="store_true", default=False)
     op.add_option("-l", "--log", action="store", default=None)
     op.add_option("--dry", action="store_true", default=False)
     op.add_option("--pattern", action="store", default="./data/*.tsv.gz")
@@ -167,6 +1280,26 @@ if __name__ == "__main__":
     op.add_option("--gaid", action="store", default="127.0.0.1:33014")
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
     op.add_option("--dvid", action="store", default="127.0.0.1:33016")
+    op.add_option("--batch-size", action="store", type="int", default=BATCH_SIZE)
+    op.add_option("--linger", action="store", type="float", default=LINGER_SECONDS)
+    op.add_option("--writers", action="store", type="int", default=WRITER_THREADS)
+    op.add_option("--queue-size", action="store", type="int", default=QUEUE_SIZE)
+    op.add_option("--engine", type="choice", choices=ENGINES, default="threads")
+    op.add_option("--in-flight", action="store", type="int", default=IN_FLIGHT)
+    op.add_option("--dead-letter", action="store", default=None)
+    op.add_option("--split-files", action="store_true", default=False)
+    op.add_option("--chunk-size", action="store", type="int", default=CHUNK_BYTES)
+    op.add_option(
+        "--metrics-interval",
+        action="store",
+        type="float",
+        default=METRICS_INTERVAL_SECONDS,
+    )
+    op.add_option("--metrics-dir", action="store", default=None)
+    op.add_option("--checkpoint-dir", action="store", default=None)
+    op.add_option(
+        "--checkpoint-bytes", action="store", type="int", default=CHECKPOINT_BYTES
+    )
     (opts, args) = op.parse_args()
     logging.basicConfig(
         filename=opts.log,
@@ -177,6 +1310,9 @@ if __name__ == "__main__":
     if opts.test:
         prototest()
         sys.exit(0)
+    if opts.bench_parser:
+        bench_parser(opts.pattern)
+        sys.exit(0)
 
     logging.info("Memc loader started with options: %s" % opts)
     try:
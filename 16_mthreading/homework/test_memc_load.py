@@ -0,0 +1,433 @@
+import asyncio
+import gzip
+import random
+import socket
+import struct
+import threading
+from multiprocessing.pool import ThreadPool
+
+import appsinstalled_pb2
+import memc_load
+import pytest
+from memc_load import (
+    AppsInstalled,
+    AsyncShardWriter,
+    Checkpoint,
+    CircuitBreaker,
+    DeadLetter,
+    ShardBuffer,
+    ShardRouter,
+    ShardWriter,
+    checkpoint_path,
+    insert_appsinstalled,
+    make_memc_client,
+    parse_appsinstalled,
+    parse_block,
+    process_block,
+    process_file,
+    process_file_chunks,
+    read_blocks,
+    serialize_many,
+    valid_record,
+)
+
+DEVICE_TYPES = ("idfa", "gaid", "adid", "dvid")
+
+
+class FakeMemcached:
+    """Answers `set` commands, the first `drops` connections are reset
+    instead of answering the (drop_after + 1)-th command."""
+
+    def __init__(self, drop_after=None, drops=0):
+        self.stored = {}
+        self.drop_after = drop_after
+        self.drops = drops
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.address = "127.0.0.1:%d" % self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            drop_after = None
+            if self.drops:
+                self.drops -= 1
+                drop_after = self.drop_after
+            threading.Thread(
+                target=self.handle, args=(conn, drop_after), daemon=True
+            ).start()
+
+    def handle(self, conn, drop_after):
+        replies = 0
+        with conn, conn.makefile("rb") as f:
+            while True:
+                header = f.readline()
+                if not header:
+                    return
+                _, key, _, _, size = header.split()
+                data = f.read(int(size) + 2)[:-2]
+                if replies == drop_after:
+                    # RST: the client gets an error, not EOF, while reading
+                    conn.setsockopt(
+                        socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+                    )
+                    return
+                self.stored[key.decode()] = data
+                conn.sendall(b"STORED\r\n")
+                replies += 1
+
+    def close(self):
+        self.sock.close()
+
+
+class ListWriter:
+    def __init__(self, address):
+        self.address = address
+        self.batches = []
+        self.errors = 0
+
+    def put(self, batch):
+        self.batches.append(batch)
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(memc_load, "backoff_delay", lambda attempt: 0)
+
+
+@pytest.fixture
+def server():
+    server = FakeMemcached()
+    yield server
+    server.close()
+
+
+def _batch(count):
+    keys = ["idfa:%d" % i for i in range(count)]
+    return dict(zip(keys, serialize_many([(55.55, 42.42, [i]) for i in range(count)])))
+
+
+def _read_dead_letter(path):
+    with gzip.open(path, "rt") as f:
+        return ["%s:%s" % tuple(line.split("\t")[:2]) for line in f]
+
+
+def _line(dev_type, dev_id, apps=(1, 2, 3)):
+    return f"{dev_type}\t{dev_id}\t55.55\t42.42\t{','.join(map(str, apps))}\n"
+
+
+def test_buffer_batches_records() -> None:
+    """test_buffer_batches_records"""
+    writer = ListWriter("idfa")
+    buffer = ShardBuffer(writer, batch_size=3, linger=60)
+    for i in range(7):
+        buffer.add("idfa:%d" % i, (55.55, 42.42, [i]))
+    assert [len(b) for b in writer.batches] == [3, 3]
+    buffer.expire(buffer.started)
+    assert len(writer.batches) == 2
+    buffer.flush()
+    assert [list(b) for b in writer.batches][2] == ["idfa:6"]
+    ua = appsinstalled_pb2.UserApps()
+    ua.ParseFromString(writer.batches[1]["idfa:4"])
+    assert (ua.lat, ua.lon, list(ua.apps)) == (55.55, 42.42, [4])
+
+
+def test_invalid_keys_are_skipped() -> None:
+    """test_invalid_keys_are_skipped"""
+    router = ShardRouter({"idfa": "idfa"}, ListWriter, 3, 60)
+    assert not router.route(AppsInstalled("idfa", "abc def", 55.5, 42.4, [1]))
+    assert not router.route(AppsInstalled("idfa", "x" * 250, 55.5, 42.4, [1]))
+    assert router.route(AppsInstalled("idfa", "abc", 55.5, 42.4, [1]))
+    router.flush()
+    assert [list(b) for b in router.writers["idfa"].batches] == [["idfa:abc"]]
+
+
+def test_linger_flushes_partial_batch() -> None:
+    """test_linger_flushes_partial_batch"""
+    router = ShardRouter({"idfa": "idfa", "gaid": "gaid"}, ListWriter, 100, 0)
+    process_block(_line("idfa", 1).encode(), router)
+    assert [len(b) for b in router.writers["idfa"].batches] == [1]
+
+
+def test_router_sends_records_to_their_device_type() -> None:
+    """test_router_sends_records_to_their_device_type"""
+    device_memc = {dev_type: "%s:11211" % dev_type for dev_type in DEVICE_TYPES}
+    router = ShardRouter(device_memc, ListWriter, 3, 60)
+    assert {d: w.address for d, w in router.writers.items()} == device_memc
+    block = "".join(_line(DEVICE_TYPES[i % 2], i) for i in range(8))
+    block += _line("xxxx", 100)
+    assert process_block(block.encode(), router) == {"OK": 8, "ERR": 1}
+    router.flush()
+    assert [list(b) for b in router.writers["idfa"].batches] == [
+        ["idfa:0", "idfa:2", "idfa:4"],
+        ["idfa:6"],
+    ]
+    assert [len(b) for b in router.writers["gaid"].batches] == [3, 1]
+    assert router.writers["adid"].batches == []
+    assert router.records == {"idfa": 4, "gaid": 4}
+    router.writers["gaid"].errors = 2
+    assert router.errors() == {**dict.fromkeys(DEVICE_TYPES, 0), "gaid": 2}
+
+
+def test_key_errors_are_not_retried(server) -> None:
+    """test_key_errors_are_not_retried"""
+    breaker = CircuitBreaker(server.address, failures=1)
+    batch = {"idfa:a b": b"x", "idfa:ok": b"y"}
+    failed = insert_appsinstalled(
+        make_memc_client(server.address), batch, False, breaker
+    )
+    assert failed == batch
+    assert breaker.failed == 0
+    assert breaker.allow()
+
+
+def test_writer_thread_survives_failed_batch(server, monkeypatch) -> None:
+    """test_writer_thread_survives_failed_batch"""
+    insert = memc_load.insert_appsinstalled
+    calls = []
+
+    def crashing(memc_client, batch, *args):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise RuntimeError("crash")
+        return insert(memc_client, batch, *args)
+
+    monkeypatch.setattr(memc_load, "insert_appsinstalled", crashing)
+    writer = ShardWriter(server.address, threads=1)
+    first, second = _batch(3), {"gaid:1": b"x"}
+    writer.put(first)
+    writer.put(second)
+    writer.close()
+    assert writer.errors == len(first)
+    assert server.stored == {"gaid:1": b"x"}
+
+
+def test_retry_after_dropped_connection(fast_retries) -> None:
+    """test_retry_after_dropped_connection"""
+    server = FakeMemcached(drop_after=3, drops=1)
+    batch = _batch(20)
+    failed = insert_appsinstalled(make_memc_client(server.address), batch)
+    server.close()
+    assert failed == {}
+    assert set(server.stored) == set(batch)
+
+
+def test_writer_recovers_from_transient_failure() -> None:
+    """test_writer_recovers_from_transient_failure"""
+    # real backoff: the first retry may come sooner than RETRY_TIMEOUT_SECONDS
+    server = FakeMemcached(drop_after=3, drops=1)
+    writer = ShardWriter(server.address, threads=1)
+    batches = [_batch(20), {"gaid:1": b"x"}, {"gaid:2": b"y"}]
+    for batch in batches:
+        writer.put(batch)
+    writer.close()
+    server.close()
+    assert writer.errors == 0
+    assert writer.breaker.failed == 0
+    assert memc_load.metrics.retries[server.address] == 1
+    assert set(server.stored) == {key for batch in batches for key in batch}
+
+
+def test_partial_failure_is_dead_lettered(tmp_path, fast_retries) -> None:
+    """test_partial_failure_is_dead_lettered"""
+    server = FakeMemcached(drop_after=3, drops=100)
+    dead_letter = DeadLetter(str(tmp_path / "failed.tsv.gz"))
+    writer = ShardWriter(server.address, threads=1, dead_letter=dead_letter)
+    batch = _batch(20)
+    writer.put(batch)
+    writer.close()
+    dead_letter.close()
+    server.close()
+    failed = _read_dead_letter(dead_letter.path)
+    # keys that never got a STORED reply must not be counted as loaded
+    assert set(batch) - set(server.stored) <= set(failed)
+    assert writer.errors == len(failed)
+
+
+def test_async_writer_fails_invalid_keys_only(server) -> None:
+    """test_async_writer_fails_invalid_keys_only"""
+
+    async def load():
+        writer = AsyncShardWriter(server.address)
+        writer.put({"idfa:a b": b"x", "idfa:ok": b"y\r\nset z 0 0 1\r\n"})
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(load())
+    assert writer.errors == 1
+    assert server.stored == {"idfa:ok": b"y\r\nset z 0 0 1\r\n"}
+
+
+def test_async_writer_resets_on_protocol_error() -> None:
+    """test_async_writer_resets_on_protocol_error"""
+
+    async def handle(reader, writer):
+        await reader.readline()
+        writer.write(b"ERROR\r\nSTORED\r\n")
+        await writer.drain()
+
+    async def load():
+        memcached = await asyncio.start_server(handle, "127.0.0.1", 0)
+        address = "127.0.0.1:%d" % memcached.sockets[0].getsockname()[1]
+        writer = AsyncShardWriter(address)
+        writer.put({"idfa:1": b"x", "idfa:2": b"y"})
+        await writer.close()
+        memcached.close()
+        return writer
+
+    assert asyncio.run(load()).errors == 2
+
+
+def test_split_file_is_loaded_once(tmp_path, monkeypatch, server) -> None:
+    """test_split_file_is_loaded_once"""
+    fn = str(tmp_path / "input.tsv.gz")
+    lines = [_line(DEVICE_TYPES[i % 4], i) for i in range(300)]
+    lines[100] = _line("xxxx", 100)
+    with gzip.open(fn, "wt") as f:
+        f.writelines(lines)
+    with gzip.open(fn) as f:
+        blocks = list(read_blocks(f, 1000))
+    assert len(blocks) > 1
+    assert all(block.endswith(b"\n") for block in blocks)
+    assert b"".join(blocks).decode() == "".join(lines)
+
+    device_memc = dict.fromkeys(DEVICE_TYPES, server.address)
+    settings = memc_load.DEFAULT_SETTINGS._replace(metrics_interval=0, chunk_size=1000)
+    checked = []
+    monkeypatch.setattr(
+        memc_load, "check_error_rate", lambda *args: checked.append(args[:2])
+    )
+    with ThreadPool(2) as pool:
+        assert process_file_chunks(pool, fn, device_memc, False, settings) == fn
+    keys = {"%s:%s" % tuple(line.split("\t")[:2]) for line in lines}
+    assert set(server.stored) == keys - {"xxxx:100"}
+    # the error rate is checked once, for the whole file
+    [(checked_fn, result)] = checked
+    assert checked_fn == fn
+    assert result.statuses == {"OK": 299, "ERR": 1}
+
+
+def test_checkpoint_resume(tmp_path, monkeypatch, server) -> None:
+    """test_checkpoint_resume"""
+    fn = str(tmp_path / "input.tsv.gz")
+    lines = [_line(DEVICE_TYPES[i % 4], i, (i, i + 1)) for i in range(300)]
+    with gzip.open(fn, "wt") as f:
+        f.writelines(lines)
+    device_memc = dict.fromkeys(DEVICE_TYPES, server.address)
+    settings = memc_load.DEFAULT_SETTINGS._replace(
+        metrics_interval=0, checkpoint_dir=str(tmp_path), checkpoint_bytes=1
+    )
+    monkeypatch.setattr(memc_load, "READ_CHUNK_BYTES", 1000)
+
+    process = memc_load.process_block
+    blocks = []
+
+    def crashing(block, router):
+        if len(blocks) == 3:
+            raise RuntimeError("crash")
+        blocks.append(block)
+        return process(block, router)
+
+    monkeypatch.setattr(memc_load, "process_block", crashing)
+    with pytest.raises(RuntimeError):
+        process_file(fn, device_memc, False, settings)
+    checkpoint = Checkpoint(checkpoint_path(fn, str(tmp_path)), fn)
+    loaded = b"".join(blocks).count(b"\n")
+    assert checkpoint.lines == loaded
+    assert checkpoint.offset == len(b"".join(blocks))
+    assert sum(checkpoint.result.records.values()) == loaded
+    keys = ["%s:%s" % tuple(line.split("\t")[:2]) for line in lines]
+    assert set(keys[:loaded]) <= set(server.stored)
+
+    monkeypatch.setattr(memc_load, "process_block", process)
+    server.stored.clear()
+    process_file(fn, device_memc, False, settings)
+    assert set(server.stored) == set(keys[loaded:])
+    checkpoint = Checkpoint(checkpoint_path(fn, str(tmp_path)), fn)
+    assert checkpoint.lines == len(lines)
+    assert sum(checkpoint.result.records.values()) == len(lines)
+
+
+def test_metrics_never_fail_the_load(tmp_path, monkeypatch, server) -> None:
+    """test_metrics_never_fail_the_load"""
+    monkeypatch.setattr(memc_load.metrics, "directory", None)
+    fn = str(tmp_path / "input.tsv.gz")
+    with gzip.open(fn, "wt") as f:
+        f.writelines(_line("idfa", i) for i in range(10))
+    device_memc = dict.fromkeys(DEVICE_TYPES, server.address)
+    metrics_dir = tmp_path / "metrics" / "node"
+    settings = memc_load.DEFAULT_SETTINGS._replace(
+        metrics_interval=0, metrics_dir=str(metrics_dir)
+    )
+    assert process_file(fn, device_memc, False, settings) == fn
+    with open(metrics_dir / "memc_load_MainProcess.prom") as f:
+        prom = f.read()
+    assert (
+        f'memc_load_writes_total{{worker="MainProcess",server="{server.address}"}}'
+        in prom
+    )
+
+    (tmp_path / "file").touch()
+    settings = settings._replace(metrics_dir=str(tmp_path / "file" / "metrics"))
+    assert process_file(fn, device_memc, False, settings) == fn
+
+
+def test_parse_block_matches_parse_appsinstalled() -> None:
+    """test_parse_block_matches_parse_appsinstalled"""
+    rng = random.Random(0)
+    lines = [
+        _line(rng.choice(DEVICE_TYPES), i, rng.sample(range(1, 10000), 5)).strip()
+        for i in range(1000)
+    ]
+    lines[10] = "idfa\tbad-apps\t55.5\t42.4\t1,x,3"
+    lines[20] = "idfa\tbad-geo\tabc\t42.4\t1,3"
+    lines[30] = "idfa\tbig-app\t55.5\t42.4\t99999999999999999999"
+    lines[40] = "idfa\tnegative-app\t55.5\t42.4\t-1"
+    lines[50] = "idfa\t\t55.5\t42.4\t1"
+    lines[60] = "idfa\tshort\t55.5"
+    records, errors = parse_block(("\n".join(lines) + "\n").encode())
+    expected = [parse_appsinstalled(line) for line in lines]
+    expected = [r for r in expected if r is not None and valid_record(r)]
+    assert sorted(records) == sorted(expected)
+    assert errors == len(lines) - len(expected) == 5
+    assert AppsInstalled("idfa", "bad-apps", 55.5, 42.4, [1, 3]) in records
+
+
+def test_serialize_many_round_trip() -> None:
+    """test_serialize_many_round_trip"""
+    records = [(55.55, 42.42, [1, 2**32 - 1]), (-1.5, 0.0, []), (0.0, 0.0, [7])]
+    decoded = []
+    for packed in serialize_many(records):
+        ua = appsinstalled_pb2.UserApps()
+        ua.ParseFromString(packed)
+        decoded.append((ua.lat, ua.lon, list(ua.apps)))
+    assert decoded == records
+
+
+def test_pack_many_matches_protobuf() -> None:
+    """test_pack_many_matches_protobuf"""
+    pb = pytest.importorskip("pb")
+    if not hasattr(pb, "pack_many"):
+        pytest.skip("pb is built without pack_many")
+    rng = random.Random(0)
+    records = [
+        (
+            rng.uniform(-90, 90),
+            rng.uniform(-180, 180),
+            [rng.randrange(2**32) for _ in range(rng.randrange(50))],
+        )
+        for _ in range(1000)
+    ]
+    records.append((0.0, 0.0, []))
+    expected = []
+    for lat, lon, apps in records:
+        ua = appsinstalled_pb2.UserApps()
+        ua.lat = lat
+        ua.lon = lon
+        ua.apps.extend(apps)
+        expected.append(ua.SerializeToString())
+    assert pb.pack_many(records) == expected
+    assert serialize_many(records) == expected
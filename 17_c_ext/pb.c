@@ -16,6 +16,12 @@
 #define STATUS_ERROR_SERIALIZATION -1
 #define STATUS_ERROR_MEMORY -2
 
+/* Keys (field number << 3 | wire type) of the UserApps message */
+#define USER_APPS_APPS_KEY 0x08
+#define USER_APPS_LAT_KEY 0x11
+#define USER_APPS_LON_KEY 0x19
+#define DOUBLE_FIELD_SIZE 9
+
 
 typedef struct pbheader_s {
     uint32_t magic;
@@ -653,6 +659,220 @@ static PyObject* py_deviceapps_xread_pb(PyObject* self, PyObject* args) {
 }
 
 
+/* ======================================================================
+    Number of bytes of `value` encoded as a protobuf varint.
+*/
+static size_t varint_size(uint32_t value) {
+
+    size_t size = 1;
+
+    while (value >= 0x80) {
+        value >>= 7;
+        size++;
+    }
+
+    return size;
+}
+
+
+/* ======================================================================
+    Write `value` to `buffer` as a protobuf varint.
+    Returns the position right after the written bytes.
+*/
+static uint8_t* write_varint(uint8_t* buffer, uint32_t value) {
+
+    while (value >= 0x80) {
+        *buffer++ = (uint8_t) (value | 0x80);
+        value >>= 7;
+    }
+    *buffer++ = (uint8_t) value;
+
+    return buffer;
+}
+
+
+/* ======================================================================
+    Write a 64-bit field with `key` and little-endian `value` to `buffer`.
+    Returns the position right after the written bytes.
+*/
+static uint8_t* write_double(uint8_t* buffer, uint8_t key, double value) {
+
+    uint64_t bits;
+    int i;
+
+    memcpy(&bits, &value, sizeof(bits));
+    *buffer++ = key;
+    for (i = 0; i < 8; i++)
+        *buffer++ = (uint8_t) (bits >> (8 * i));
+
+    return buffer;
+}
+
+
+/* ======================================================================
+    Serialize the UserApps message used by memc_load
+    (16_mthreading/homework/appsinstalled.proto) without protobuf-c:
+
+        message UserApps {
+            repeated uint32 apps = 1;
+            optional double lat = 2;
+            optional double lon = 3;
+        }
+
+    `apps` are written unpacked, one key per item, and `lat`/`lon` are always
+    set, so the result is the same as `UserApps.SerializeToString()`.
+
+    Returns a new bytes object or `NULL` if an error occured.
+*/
+static PyObject* pack_user_apps(double lat, double lon, PyObject* py_apps) {
+
+    PyObject* apps;
+    PyObject* result;
+    uint32_t* values = NULL;
+    unsigned long item;
+    uint8_t* buffer;
+    Py_ssize_t apps_len;
+    Py_ssize_t i;
+    size_t packed_size = 2 * DOUBLE_FIELD_SIZE;
+
+    apps = PySequence_Fast(py_apps, "apps must be a sequence of integers.");
+    if (apps == NULL)
+        return NULL;
+
+    apps_len = PySequence_Fast_GET_SIZE(apps);
+
+    if (apps_len) {
+        values = malloc(sizeof(uint32_t) * apps_len);
+        if (!values) {
+            Py_DECREF(apps);
+            return PyErr_NoMemory();
+        }
+    }
+
+    for (i = 0; i < apps_len; i++) {
+        item = PyLong_AsUnsignedLong(PySequence_Fast_GET_ITEM(apps, i));
+
+        if (PyErr_Occurred() == NULL && item > UINT32_MAX)
+            PyErr_SetString(PyExc_ValueError, "App id is out of uint32 range.");
+        else if (PyErr_ExceptionMatches(PyExc_OverflowError))
+            PyErr_SetString(PyExc_ValueError, "App id is out of uint32 range.");
+
+        if (PyErr_Occurred() != NULL) {
+            free(values);
+            Py_DECREF(apps);
+            return NULL;
+        }
+
+        values[i] = (uint32_t) item;
+        packed_size += 1 + varint_size(values[i]);
+    }
+    Py_DECREF(apps);
+
+    result = PyBytes_FromStringAndSize(NULL, packed_size);
+    if (result == NULL) {
+        free(values);
+        return NULL;
+    }
+
+    buffer = (uint8_t*) PyBytes_AS_STRING(result);
+    for (i = 0; i < apps_len; i++) {
+        *buffer++ = USER_APPS_APPS_KEY;
+        buffer = write_varint(buffer, values[i]);
+    }
+    buffer = write_double(buffer, USER_APPS_LAT_KEY, lat);
+    write_double(buffer, USER_APPS_LON_KEY, lon);
+    free(values);
+
+    return result;
+}
+
+
+/* ======================================================================
+    Pack `lat`, `lon` and a sequence of `apps` to UserApps protobuf bytes.
+*/
+static PyObject* py_pack_user_apps(PyObject* self, PyObject* args) {
+
+    PyObject* apps;
+    double lat;
+    double lon;
+
+    if (!PyArg_ParseTuple(args, "ddO", &lat, &lon, &apps))
+        return NULL;
+
+    return pack_user_apps(lat, lon, apps);
+}
+
+
+/* ======================================================================
+    Read iterator of `(lat, lon, apps)` tuples.
+    Return a list with UserApps protobuf bytes of every tuple.
+*/
+static PyObject* py_pack_many(PyObject* self, PyObject* args) {
+
+    PyObject* iterable;
+    PyObject* iterator;
+    PyObject* record;
+    PyObject* apps;
+    PyObject* packed;
+    PyObject* list;
+    double lat;
+    double lon;
+    int is_error;
+
+    if (!PyArg_ParseTuple(args, "O", &iterable))
+        return NULL;
+
+    iterator = PyObject_GetIter(iterable);
+    if (iterator == NULL)
+        return NULL;
+
+    list = PyList_New(0);
+    if (list == NULL) {
+        Py_DECREF(iterator);
+        return NULL;
+    }
+
+    while ((record = PyIter_Next(iterator))) {
+
+        if (!PyTuple_Check(record))
+            PyErr_SetString(PyExc_TypeError, "Records must be (lat, lon, apps) tuples.");
+
+        if (PyErr_Occurred() != NULL || !PyArg_ParseTuple(record, "ddO", &lat, &lon, &apps)) {
+            Py_DECREF(record);
+            Py_DECREF(iterator);
+            Py_DECREF(list);
+            return NULL;
+        }
+
+        packed = pack_user_apps(lat, lon, apps);
+        Py_DECREF(record);
+
+        if (packed == NULL) {
+            Py_DECREF(iterator);
+            Py_DECREF(list);
+            return NULL;
+        }
+
+        is_error = PyList_Append(list, packed);
+        Py_DECREF(packed);
+
+        if (is_error) {
+            Py_DECREF(iterator);
+            Py_DECREF(list);
+            return NULL;
+        }
+    }
+    Py_DECREF(iterator);
+
+    if (PyErr_Occurred() != NULL) {
+        Py_DECREF(list);
+        return NULL;
+    }
+
+    return list;
+}
+
+
 /* ======================================================================
    Initialize module
 */
@@ -669,6 +889,18 @@ static PyMethodDef PBMethods[] = {
         METH_VARARGS, 
         "Deserialize protobuf from file, return iterator"
     },
+    {
+        "pack_user_apps",
+        py_pack_user_apps,
+        METH_VARARGS,
+        "Serialize lat, lon and apps to UserApps protobuf bytes"
+    },
+    {
+        "pack_many",
+        py_pack_many,
+        METH_VARARGS,
+        "Serialize an iterator of (lat, lon, apps) tuples, return list of bytes"
+    },
     {
         NULL, 
         NULL,
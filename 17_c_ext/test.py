@@ -11,6 +11,10 @@ def main():
     unpacked = list(pb.deviceapps_xread_pb(TEST_FILE))
     print(unpacked)
 
+    packed = pb.pack_user_apps(55.55, 42.42, [1423, 43, 567])
+    print(packed)
+    assert pb.pack_many([(55.55, 42.42, [1423, 43, 567])]) == [packed]
+
 
 if __name__ == "__main__":
     main()